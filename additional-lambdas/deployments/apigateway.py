@@ -11,6 +11,7 @@ def create_lambda(role):
 	import zipfile
 	zf = zipfile.ZipFile('deployment_lambda.zip', mode='w')
 	zf.write('deployment.py')
+	zf.write(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'shared', 'es_client.py'), 'es_client.py')
 	zf.close()
 
 	with open('deployment_lambda.zip', 'rb') as zfile:
@@ -59,7 +60,7 @@ def create_api_gateway(endpoint, lambda_arn):
 			'application/json': template
 		},
 		integrationHttpMethod='POST',
-		uri='arn:aws:apigateway:ap-southeast-2:lambda:path/2015-03-31/functions/{}/invocations'.format(lambda_arn)
+		uri='arn:aws:apigateway:{}:lambda:path/2015-03-31/functions/{}/invocations'.format(session.region_name, lambda_arn)
 	)
 
 	apigateway.put_method_response(
@@ -139,7 +140,7 @@ def main():
 	lambda_arn = create_lambda(args.role)
 	api_id = create_api_gateway(args.endpoint, lambda_arn)
 
-	url = 'https://' + api_id + '.execute-api.ap-southeast-2.amazonaws.com/prod'
+	url = 'https://' + api_id + '.execute-api.' + session.region_name + '.amazonaws.com/prod'
 	print('API Gateway endpoint: ' + url)
 	print('\nExample invocation: curl -H "Content-Type: application/json" -X POST '
 			'-d \'{"timestamp": "2016-10-26T02:56:47.158Z", "Application": "APPNAME",'
@@ -0,0 +1,161 @@
+from __future__ import print_function
+import datetime
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+
+# The number of resources returned in each page of a listing call
+PAGE_SIZE = 100
+
+
+class FakeClient(object):
+    """
+    A local stand-in for a boto3 client. Every call is counted in stats, delayed by the latency, and
+    a fraction of calls are rejected with a Throttling error, as AWS does when a client calls too often.
+    """
+
+    # The listing operations of the client that can be paginated
+    paginated = []
+
+    def __init__(self, stats, latency=0.0, throttle_rate=0.0):
+        """
+        :param stats: A dict that the number of calls to each operation is counted in, shared between clients
+        :param latency: The number of seconds each call takes
+        :param throttle_rate: The fraction of calls that are throttled
+        """
+
+        self.stats = stats
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.lock = threading.Lock()
+
+    def record(self, operation):
+        """
+        Counts a call, waits for the latency, and raises a Throttling error for the throttled fraction of calls.
+        """
+
+        with self.lock:
+            self.stats[operation] = self.stats.get(operation, 0) + 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if random.random() < self.throttle_rate:
+            with self.lock:
+                self.stats['throttled'] = self.stats.get('throttled', 0) + 1
+            raise ClientError({'Error': {'Code': 'Throttling', 'Message': 'Rate exceeded'}}, operation)
+
+    def can_paginate(self, operation):
+        return operation in self.paginated
+
+    def get_paginator(self, operation):
+        return FakePaginator(getattr(self, operation))
+
+
+class FakePaginator(object):
+    """
+    Follows the NextToken of a FakeClient listing operation, like a boto3 paginator.
+    """
+
+    def __init__(self, operation):
+        self.operation = operation
+
+    def paginate(self, **kwargs):
+        while True:
+            page = self.operation(**kwargs)
+            yield page
+            if not page.get('NextToken'):
+                return
+            kwargs['NextToken'] = page['NextToken']
+
+
+def list_page(items, next_token):
+    """
+    :param items: Every item of a listing
+    :param next_token: The NextToken of the request, or None for the first page
+    :return: The items in the page, and the NextToken of the following page if there is one
+    """
+
+    start = int(next_token or 0)
+    end = start + PAGE_SIZE
+    return items[start:end], str(end) if end < len(items) else None
+
+
+class FakeCloudWatch(FakeClient):
+    """
+    Answers GetMetricData with two datapoints for every query.
+    """
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, **kwargs):
+        self.record('GetMetricData')
+        end = EndTime.replace(second=0, microsecond=0, minute=EndTime.minute - EndTime.minute % 5)
+        timestamps = [end - datetime.timedelta(minutes=5), end - datetime.timedelta(minutes=10)]
+
+        return {'MetricDataResults': [{
+            'Id': query['Id'],
+            'Label': query['MetricStat']['Metric']['MetricName'],
+            'Timestamps': timestamps,
+            'Values': [random.uniform(0, 100) for _ in timestamps],
+            'StatusCode': 'Complete'
+        } for query in MetricDataQueries]}
+
+
+class FakeEC2(FakeClient):
+    """
+    Lists a configurable number of EBS volumes.
+    """
+
+    paginated = ['describe_volumes']
+
+    def __init__(self, stats, volumes=0, **kwargs):
+        super(FakeEC2, self).__init__(stats, **kwargs)
+        self.volumes = [{'VolumeId': 'vol-{0:08x}'.format(number)} for number in range(volumes)]
+
+    def describe_volumes(self, NextToken=None, **kwargs):
+        self.record('DescribeVolumes')
+        volumes, next_token = list_page(self.volumes, NextToken)
+        return {'Volumes': volumes, 'NextToken': next_token}
+
+
+class FakeRDS(FakeClient):
+    """
+    Lists a configurable number of RDS instances.
+    """
+
+    paginated = ['describe_db_instances']
+
+    def __init__(self, stats, databases=0, **kwargs):
+        super(FakeRDS, self).__init__(stats, **kwargs)
+        self.databases = [{'DBInstanceIdentifier': 'database-{0}'.format(number)} for number in range(databases)]
+
+    def describe_db_instances(self, NextToken=None, **kwargs):
+        self.record('DescribeDBInstances')
+        databases, next_token = list_page(self.databases, NextToken)
+        return {'DBInstances': databases, 'NextToken': next_token}
+
+
+class FakeElasticsearchService(FakeClient):
+    """
+    Describes a single elasticsearch domain with the provided endpoint.
+    """
+
+    def __init__(self, stats, endpoint, **kwargs):
+        super(FakeElasticsearchService, self).__init__(stats, **kwargs)
+        self.endpoint = endpoint
+
+    def describe_elasticsearch_domain(self, DomainName):
+        self.record('DescribeElasticsearchDomain')
+        return {'DomainStatus': {'DomainName': DomainName, 'Endpoint': self.endpoint, 'Processing': False}}
+
+
+class FakeBoto3(object):
+    """
+    Stands in for the boto3 module of a lambda, handing out the provided fake clients.
+    """
+
+    def __init__(self, clients):
+        self.clients = clients
+
+    def client(self, service, **kwargs):
+        return self.clients[service]
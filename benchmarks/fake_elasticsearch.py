@@ -0,0 +1,265 @@
+from __future__ import print_function
+import BaseHTTPServer
+import SocketServer
+import cStringIO
+import calendar
+import datetime
+import gzip
+import json
+import os
+import random
+import threading
+import time
+
+# The cw- template, whose _default_ properties elasticsearch merges into the mapping of every type in a cw- index
+CW_TEMPLATE_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'template_mappings',
+                                'cw_template.json')
+
+# The fields the collector's documents hold in each type of a cw- index. Each metric is its own type, with the id
+# field of its namespace, the account it was collected from and the metric's own numeric field.
+CW_DOCUMENT_FIELDS = {
+    'CPUUtilization': {
+        'timestamp': {'type': 'date', 'format': 'strict_date_optional_time||epoch_millis'},
+        'database_id': {'type': 'string', 'index': 'not_analyzed'},
+        'account': {'type': 'string', 'index': 'not_analyzed'},
+        'unit': {'type': 'string', 'index': 'not_analyzed'},
+        'period': {'type': 'integer'},
+        'CPUUtilization': {'type': 'double'}
+    },
+    'FreeStorageSpace': {
+        'timestamp': {'type': 'date', 'format': 'strict_date_optional_time||epoch_millis'},
+        'database_id': {'type': 'string', 'index': 'not_analyzed'},
+        'account': {'type': 'string', 'index': 'not_analyzed'},
+        'unit': {'type': 'string', 'index': 'not_analyzed'},
+        'FreeStorageSpace': {'type': 'long'}
+    },
+    'VolumeReadBytes': {
+        'timestamp': {'type': 'date', 'format': 'strict_date_optional_time||epoch_millis'},
+        'volume_id': {'type': 'string', 'index': 'not_analyzed'},
+        'account': {'type': 'string', 'index': 'not_analyzed'},
+        'unit': {'type': 'string', 'index': 'not_analyzed'},
+        'VolumeReadBytes': {'type': 'long'}
+    }
+}
+
+
+def cw_mappings():
+    """
+    :return: The mappings of a cw- index as a domain reports them, with the template's _default_ properties merged
+    into every type, so each type also maps every id field and the metrics the template lists
+    """
+
+    with open(CW_TEMPLATE_PATH) as template_file:
+        default = json.load(template_file)['mappings']['_default_']
+
+    mappings = {'_default_': default}
+    for document_type, fields in CW_DOCUMENT_FIELDS.items():
+        properties = dict(default.get('properties', {}))
+        properties.update(fields)
+        mappings[document_type] = {'properties': properties}
+
+    return mappings
+
+
+CW_MAPPINGS = cw_mappings()
+
+# The accounts the documents of cw- indices were collected from
+ACCOUNTS = ['111111111111', '222222222222']
+
+
+class FakeElasticsearch(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local stand-in for an elasticsearch domain, answering the requests the lambdas make: _bulk, _cat/indices,
+    _cat/allocation, _mapping, _search, _settings, _forcemerge, _alias and index deletes. Requests must be SigV4
+    signed, like a domain with an IAM access policy, and every request is counted in stats.
+    cw- indices have the mappings in CW_MAPPINGS, and _search answers the terms, date_histogram and stats
+    aggregations of a rollup with buckets for every resource, account and hour of the index's day.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, indices=(), latency=0.0, reject_rate=0.0, disk_total=0, disk_available=0, resources=10):
+        """
+        :param indices: The indices listed by _cat/indices, as dicts of the columns the curator requests
+        :param latency: The number of seconds to wait before answering each request
+        :param reject_rate: The fraction of _bulk documents rejected with a 429, as a busy domain would
+        :param disk_total: The bytes of disk listed by _cat/allocation
+        :param disk_available: The bytes of free disk listed by _cat/allocation
+        :param resources: The number of resources of each type in a cw- index
+        """
+
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), RequestHandler)
+        self.indices = [dict(index) for index in indices]
+        self.latency = latency
+        self.reject_rate = reject_rate
+        self.disk_total = disk_total
+        self.disk_available = disk_available
+        self.resources = resources
+        self.stats = {'requests': 0, 'bytes_received': 0, 'bytes_sent': 0, 'documents': 0, 'rejected': 0,
+                      'rollup_documents': 0, 'deleted_indices': 0, 'unsigned': 0}
+        self.aliases = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """
+        Serves requests on a background thread.
+        :return: The port the server is listening on
+        """
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server_address[1]
+
+    def record(self, **counts):
+        """
+        Adds to the counts in stats.
+        """
+
+        with self.lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers a single request to the FakeElasticsearch server.
+    """
+
+    # Keep-alive, so the connection reuse of the elasticsearch client is measured
+    protocol_version = 'HTTP/1.1'
+
+    # Responses are written in one go, otherwise each header is its own packet and is held up by delayed acks
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def handle_any(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.getheader('content-length') or 0))
+        server.record(requests=1, bytes_received=len(body))
+
+        if server.latency:
+            time.sleep(server.latency)
+
+        if not (self.headers.getheader('authorization') or '').startswith('AWS4-HMAC-SHA256'):
+            server.record(unsigned=1)
+            return self.reply(403, {'message': 'Request is not signed'})
+
+        if self.headers.getheader('content-encoding') == 'gzip':
+            body = gzip.GzipFile(fileobj=cStringIO.StringIO(body)).read()
+
+        path = self.path.partition('?')[0]
+
+        if path == '/_bulk':
+            return self.reply(200, self.bulk(body))
+        if path.startswith('/_cat/indices'):
+            with server.lock:
+                indices = list(server.indices)
+            return self.reply(200, indices)
+        if path.startswith('/_cat/allocation'):
+            return self.reply(200, [{'node': 'benchmark', 'disk.total': str(server.disk_total),
+                                     'disk.avail': str(server.disk_available)}])
+        if path.endswith('/_mapping'):
+            index = path.split('/')[1]
+            return self.reply(200, {index: {'mappings': CW_MAPPINGS if index.startswith('cw-') else {}}})
+        if path.endswith('/_search'):
+            index = path.split('/')[1]
+            day = datetime.datetime.strptime(index[-len('YYYY.MM.DD'):], '%Y.%m.%d')
+            return self.reply(200, {'took': 1, 'timed_out': False, 'hits': {'total': 0, 'hits': []},
+                                    'aggregations': self.aggregations(json.loads(body).get('aggs', {}), day)})
+        if path.startswith('/_settings'):
+            return self.reply(200, {})
+        if '/_alias/' in path:
+            index, _, alias = path.partition('/_alias/')
+            if self.command == 'PUT':
+                with server.lock:
+                    server.aliases.setdefault(alias, set()).add(index.strip('/'))
+                return self.reply(200, {'acknowledged': True})
+            with server.lock:
+                aliased = sorted(server.aliases.get(alias, []))
+            if not aliased:
+                return self.reply(404, {'error': 'alias [{0}] missing'.format(alias), 'status': 404})
+            return self.reply(200, dict((name, {'aliases': {alias: {}}}) for name in aliased))
+        if self.command == 'DELETE':
+            deleted = set(path.strip('/').split(','))
+            with server.lock:
+                server.indices = [index for index in server.indices if index['index'] not in deleted]
+                for indices in server.aliases.values():
+                    indices -= deleted
+            server.record(deleted_indices=len(deleted))
+
+        return self.reply(200, {'acknowledged': True})
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_any
+
+    def aggregations(self, aggs, day, document_type=None):
+        """
+        :param aggs: The aggregations of a _search request
+        :param day: The day of the index being searched
+        :param document_type: The type of the documents being aggregated, inside a terms aggregation on _type
+        :return: The results of the aggregations, with a bucket for every type, resource, account and hour
+        """
+
+        results = {}
+        for name, agg in aggs.items():
+            if 'filter' in agg:
+                # Only exists filters are used, and a type's documents only hold their own fields
+                field = agg['filter']['exists']['field']
+                held = field in CW_DOCUMENT_FIELDS.get(document_type, {})
+                results[name] = {'doc_count': 12 * self.server.resources * len(ACCOUNTS) if held else 0}
+                continue
+            if 'stats' in agg:
+                value = random.random() * 100
+                results[name] = {'count': 12, 'min': value / 2, 'max': value * 2, 'avg': value, 'sum': value * 12}
+                continue
+            if 'terms' in agg and agg['terms']['field'] == '_type':
+                types = sorted(CW_DOCUMENT_FIELDS)
+                results[name] = {'buckets': [dict(self.aggregations(agg.get('aggs', {}), day, key), key=key,
+                                                  doc_count=12) for key in types]}
+                continue
+            if 'terms' in agg and agg['terms']['field'] == 'account':
+                keys = ACCOUNTS
+            elif 'terms' in agg:
+                keys = ['{0}-{1}'.format(agg['terms']['field'], number) for number in range(self.server.resources)]
+            else:
+                start = calendar.timegm(day.timetuple()) * 1000
+                keys = [start + hour * 3600 * 1000 for hour in range(24)]
+            results[name] = {'buckets': [dict(self.aggregations(agg.get('aggs', {}), day, document_type), key=key,
+                                              doc_count=12) for key in keys]}
+
+        return results
+
+    def bulk(self, body):
+        """
+        :return: A _bulk response with an item for every action line of the request
+        """
+
+        items = []
+        rejected = 0
+        rollups = 0
+
+        for action_line in body.splitlines()[::2]:
+            action = list(json.loads(action_line).values())[0]
+            if (action.get('_index') or '').startswith('rollup-'):
+                rollups += 1
+            if random.random() < self.server.reject_rate:
+                rejected += 1
+                items.append({'index': {'_index': action.get('_index'), 'status': 429,
+                                        'error': 'rejected execution of bulk request'}})
+            else:
+                items.append({'index': {'_index': action.get('_index'), 'status': 201}})
+
+        self.server.record(documents=len(items) - rejected, rejected=rejected, rollup_documents=rollups)
+        return {'took': 1, 'errors': rejected > 0, 'items': items}
+
+    def reply(self, status, data):
+        body = json.dumps(data)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.server.record(bytes_sent=len(body))
@@ -0,0 +1,267 @@
+from __future__ import print_function
+import argparse
+import datetime
+import httplib
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+# The lambdas are imported from their folders in ./lambdas, which elk.py packages, so no .pyc files are left there
+sys.dont_write_bytecode = True
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+# The lambda code being benchmarked, imported the same way lambda imports it from the package
+MODULE_DIRS = [
+    BENCHMARKS_DIR,
+    os.path.join(REPO_DIR, 'shared'),
+    os.path.join(REPO_DIR, 'lambdas', 'cloudwatch_other_metrics'),
+    os.path.join(REPO_DIR, 'lambdas', 'elk_curator')
+]
+
+# The endpoint the lambdas are given. Requests are signed for it, but sent to the local stand-in.
+ENDPOINT = 'search-benchmark.ap-southeast-2.es.amazonaws.com'
+
+CASES = ['collector', 'transform', 'bulk', 'curator']
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+# The metrics collected for each namespace. Resources are split evenly between the namespaces.
+METRICS = {
+    'AWS/EBS': ['VolumeReadBytes', 'VolumeWriteBytes'],
+    'AWS/RDS': ['CPUUtilization', 'FreeStorageSpace', 'FreeableMemory']
+}
+
+# The prefixes, and days kept for, of the indices given to the curator
+RETENTION = {'cw-': 30, 'cost-': 365, 'repo-': 365}
+
+# The size of each index given to the curator
+INDEX_BYTES = 100 * 1024 * 1024
+
+
+def parse_args():
+    """
+    Parses the command line arguments for use throughout the script
+    :return:
+    """
+
+    parser = argparse.ArgumentParser(description='Benchmarks the lambdas against local stand-ins for elasticsearch '
+                                                 'and AWS, for fleets of different sizes')
+    parser.add_argument('-c', '--cases', default=','.join(CASES),
+                        help='Comma separated cases to run. options: {0}. default: all'.format(', '.join(CASES)))
+    parser.add_argument('-s', '--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='Comma separated numbers of resources (or indices, for the curator) to run each case '
+                             'with. default: {0}'.format(','.join(str(size) for size in DEFAULT_SIZES)))
+    parser.add_argument('-w', '--workers', default=4, type=int,
+                        help='The workers setting given to the collector. default: 4')
+    parser.add_argument('--aws-latency', default=0.0, type=float,
+                        help='Seconds each AWS call takes. default: 0')
+    parser.add_argument('--es-latency', default=0.0, type=float,
+                        help='Seconds each elasticsearch request takes. default: 0')
+    parser.add_argument('--throttle-rate', default=0.0, type=float,
+                        help='Fraction of GetMetricData calls that are throttled. default: 0')
+    parser.add_argument('--reject-rate', default=0.0, type=float,
+                        help='Fraction of _bulk documents elasticsearch rejects as too busy. default: 0')
+    parser.add_argument('--compress', action='store_true',
+                        help='Gzip _bulk requests')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as json, eg. to compare against a previous run')
+    parser.add_argument('--child', nargs=2, metavar=('CASE', 'SIZE'), help=argparse.SUPPRESS)
+
+    return parser.parse_args()
+
+
+def main():
+    """
+    Runs every case at every size, each in its own process so their memory use is measured separately
+
+    """
+
+    args = parse_args()
+
+    if args.child:
+        print(json.dumps(run_case(args.child[0], int(args.child[1]), args)))
+        return
+
+    options = ['--workers', str(args.workers), '--aws-latency', str(args.aws_latency),
+               '--es-latency', str(args.es_latency), '--throttle-rate', str(args.throttle_rate),
+               '--reject-rate', str(args.reject_rate)] + (['--compress'] if args.compress else [])
+
+    results = []
+    for case in args.cases.split(','):
+        for size in [int(size) for size in args.sizes.split(',')]:
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--child', case, str(size)]
+                                             + options)
+            results.append(json.loads(output.strip().splitlines()[-1]))
+            if not args.json:
+                print_result(results[-1], header=len(results) == 1)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+def print_result(result, header=False):
+    """
+    Prints the result of a case as a row of a table
+    """
+
+    row = '{0:<10} {1:>9} {2:>9} {3:>10} {4:>12} {5:>13} {6:>10} {7:>11}'
+    if header:
+        print(row.format('case', 'resources', 'wall (s)', 'aws calls', 'es requests', 'payload (KB)', 'documents',
+                         'memory (MB)'))
+    print(row.format(result['case'], result['size'], '{0:.3f}'.format(result['wall_seconds']),
+                     sum(count for operation, count in result['aws_calls'].items() if operation != 'throttled'),
+                     result['es']['requests'], '{0:.1f}'.format(result['payload_bytes'] / 1024.0),
+                     result['es']['documents'], '{0:.1f}'.format(result['peak_memory_kb'] / 1024.0)))
+
+
+def run_case(case, size, args):
+    """
+    Runs one case against fresh stand-ins.
+    :param case: The name of the case to run
+    :param size: The number of resources, or indices for the curator
+    :param args: The parsed command line arguments
+    :return: A dict of the calls made, wall time, payload bytes and peak memory growth of the case
+    """
+
+    # The lambdas sign requests with the credentials of their role, which only need to look valid here
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'ap-southeast-2')
+    sys.path[:0] = MODULE_DIRS
+
+    import fake_aws
+    import fake_elasticsearch
+
+    indices = dated_indices(size) if case == 'curator' else []
+    # Enough disk is used that the curator also has to delete indices to free up space
+    disk_total = max(len(indices), 1) * INDEX_BYTES
+    server = fake_elasticsearch.FakeElasticsearch(indices, latency=args.es_latency, reject_rate=args.reject_rate,
+                                                  disk_total=disk_total, disk_available=disk_total // 10)
+    port = server.start()
+
+    # The elasticsearch client connects over https to the host it is given, so it is pointed at the local server
+    class LocalConnection(httplib.HTTPConnection):
+        def __init__(self, host, timeout=None, **kwargs):
+            httplib.HTTPConnection.__init__(self, '127.0.0.1', port, timeout=timeout)
+    httplib.HTTPSConnection = LocalConnection
+
+    aws_calls = {}
+    # Real clients retry throttled calls themselves, which the stand-ins don't, so only the GetMetricData calls
+    # the collector backs off from itself are throttled
+    client_options = {'latency': args.aws_latency}
+    payload_bytes = None
+
+    import cloudwatch_other_metrics
+    import elk_curator
+
+    if case in ['collector']:
+        cloudwatch_other_metrics.clients[('cloudwatch', None)] = fake_aws.FakeCloudWatch(
+            aws_calls, throttle_rate=args.throttle_rate, **client_options)
+        cloudwatch_other_metrics.clients[('ec2', None)] = fake_aws.FakeEC2(aws_calls, volumes=size // 2,
+                                                                           **client_options)
+        cloudwatch_other_metrics.clients[('rds', None)] = fake_aws.FakeRDS(aws_calls, databases=size - size // 2,
+                                                                           **client_options)
+        run = lambda: cloudwatch_other_metrics.get_other_metrics({
+            'endpoint': ENDPOINT,
+            'measurement': 'Average',
+            'workers': args.workers,
+            'compress': args.compress,
+            'metrics': METRICS
+        })
+    elif case in ['transform', 'bulk']:
+        data = synthetic_metrics(size)
+        if case == 'transform':
+            run = lambda: len(cloudwatch_other_metrics.transform_data(data))
+        else:
+            # The same retry budget the lambda gives itself
+            run = lambda: cloudwatch_other_metrics.send_bulk(
+                ENDPOINT, cloudwatch_other_metrics.generate_bulk_lines(data), compress=args.compress,
+                retry_deadline=time.time() + cloudwatch_other_metrics.DEFAULT_BULK_RETRY_SECONDS)
+    elif case in ['curator']:
+        elk_curator.boto3 = fake_aws.FakeBoto3({
+            'es': fake_aws.FakeElasticsearchService(aws_calls, ENDPOINT, **client_options)
+        })
+        run = lambda: elk_curator.run_curator('benchmark', retention=RETENTION, target_free_percent=20,
+                                              optimise_after_days=1, rollup_prefixes=['cw-'])
+    else:
+        raise RuntimeError('Unrecognised case {0}, please set one of {1}'.format(case, ', '.join(CASES)))
+
+    # The lambdas print progress for every index and document they fail on, which would swamp the results
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        baseline_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        started = time.time()
+        result = run()
+        wall_seconds = time.time() - started
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    if case == 'transform':
+        payload_bytes = result
+
+    # Closing the pooled connections lets the server's keep-alive threads finish before it shuts down
+    import es_client
+    for connections in es_client.connection_pool.values():
+        for connection in connections:
+            connection.close()
+    server.shutdown()
+    server.server_close()
+
+    return {
+        'case': case,
+        'size': size,
+        'wall_seconds': wall_seconds,
+        'aws_calls': aws_calls,
+        'es': server.stats,
+        'payload_bytes': server.stats['bytes_received'] if payload_bytes is None else payload_bytes,
+        'peak_memory_kb': peak_memory - baseline_memory
+    }
+
+
+def synthetic_metrics(size):
+    """
+    :param size: The number of resources
+    :return: Pulled metrics for that many resources, in the format get_metrics returns them
+    """
+
+    data = []
+    for namespace, id_field in [('AWS/EBS', 'volume_id'), ('AWS/RDS', 'database_id')]:
+        count = size // 2 if namespace == 'AWS/EBS' else size - size // 2
+        data.append(dict(
+            ('{0}-{1}'.format(id_field, number), [
+                {'metric': metric, 'value': float(number), 'unit': 'None', id_field: '{0}-{1}'.format(id_field, number)}
+                for metric in METRICS[namespace]
+            ])
+            for number in range(count)))
+
+    return data
+
+
+def dated_indices(size):
+    """
+    :param size: The number of indices
+    :return: That many daily indices, spread across the RETENTION prefixes and going back from today,
+    as _cat/indices lists them
+    """
+
+    today = datetime.datetime.now()
+    prefixes = sorted(RETENTION)
+
+    return [{
+        'index': '{0}{1}'.format(prefixes[number % len(prefixes)],
+                                 (today - datetime.timedelta(days=number // len(prefixes))).strftime('%Y.%m.%d')),
+        'status': 'open',
+        'docs.count': '1000',
+        'store.size': str(INDEX_BYTES)
+    } for number in range(size)]
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,100 @@
 import boto3
 import argparse
+import base64
+import concurrent.futures
+import hashlib
+import io
 import json
 import time
 import requests
 import zipfile
 import re
 import os
-
-
-def create_elasticsearch_domain(name, account_id, boto_session, lambda_role, cidr):
+import random
+import urllib.parse
+
+# Modules packaged with every python lambda function
+SHARED_MODULES_DIR = './shared'
+
+# Compiled python files are left next to the source when a lambda is run locally, eg. by the benchmarks.
+# They would change the package's hash and code on every update, so they are never packaged.
+UNPACKAGED_SUFFIXES = ('.pyc', '.pyo')
+
+# Built lambda packages are kept here, named by their folder and a hash of their source
+PACKAGE_CACHE_DIR = './.package_cache'
+
+# Every file in a lambda package is given this timestamp, so packages built from the same source are identical
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# The number of lambda functions to deploy at once
+DEFAULT_DEPLOY_WORKERS = 8
+
+# The index kibana keeps its index patterns and config in, and the version of kibana to configure
+# if kibana hasn't saved its own config yet
+KIBANA_INDEX = '.kibana-4'
+DEFAULT_KIBANA_VERSION = '4.1.2'
+
+# Responses from the elasticsearch domain that mean it is busy, and how many times to retry them
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+DEFAULT_BOOTSTRAP_RETRIES = 4
+
+# The number of elk instances in a fleet manifest to work on at once
+DEFAULT_FLEET_WORKERS = 4
+
+# The permissions given to the lambda functions. `-a update` brings the policy of existing stacks up to date with it.
+LAMBDA_POLICY_DOCUMENT = {
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Action": [
+                "ec2:DescribeInstances",
+                "ec2:DescribeVolumes",
+                "rds:DescribeDBInstances",
+                "cloudfront:ListDistributions",
+                "elasticloadbalancing:DescribeLoadBalancers",
+                "dynamodb:ListTables",
+                "lambda:ListFunctions",
+                "sqs:ListQueues",
+                "sts:AssumeRole",
+                "cloudwatch:GetMetricStatistics",
+                "cloudwatch:GetMetricData",
+                "es:*",
+                "s3:*"
+            ],
+            "Resource": "*"
+        },
+        {
+            "Effect": "Allow",
+            "Action": [
+                "logs:CreateLogGroup",
+                "logs:CreateLogStream",
+                "logs:PutLogEvents"
+            ],
+            "Resource": "arn:aws:logs:*:*:*"
+        }
+    ]
+}
+
+# IAM keeps at most this many versions of a policy
+MAX_POLICY_VERSIONS = 5
+
+CIDR_PATTERN = r'^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])(\/([0-9]|[1-2][0-9]|3[0-2]))$'
+
+# How long to wait for a new elasticsearch domain, and how often to check on it. Domains usually take 10-15 minutes.
+DEFAULT_DOMAIN_TIMEOUT = 1800
+DEFAULT_WAIT_INTERVAL = 15
+DEFAULT_MAX_WAIT_INTERVAL = 60
+DEFAULT_WAIT_BACKOFF = 1.5
+DEFAULT_WAIT_JITTER = 0.1
+
+
+def create_elasticsearch_domain(name, boto_elasticsearch):
     """
-    Create Elastic Search Domain
+    Starts creating an Elastic Search Domain. Use wait_for_domain to wait for it to be ready.
 
     """
 
-    boto_elasticsearch = boto_session.client('es')
-    total_time = 0
-
-    resource = "arn:aws:es:ap-southeast-2:{0}:domain/{1}/*".format(account_id, name)
-
-    access_policy = {"Version": "2012-10-17", "Statement": [
-        {"Effect": "Allow", "Principal": {"AWS": str(lambda_role)}, "Action": "es:*", "Resource": resource},
-        {"Effect": "Allow", "Principal": {"AWS": "*"}, "Action": "es:*", "Resource": resource,
-         "Condition": {"IpAddress": {"aws:SourceIp": "{0}".format(cidr)}}}
-    ]}
-
-    endpoint = None
-
-    time.sleep(5)
-
     try:
         print('Creating elasticsearch domain: {0}'.format(name))
         boto_elasticsearch.create_elasticsearch_domain(
@@ -46,257 +112,707 @@ def create_elasticsearch_domain(name, account_id, boto_session, lambda_role, cid
                 'VolumeSize': 20
             }
         )
-        time.sleep(10)
-
-        attempts = 1
-        while True:
-            print('Trying to apply access policies to elasticsearch domain: {0} (attempt: {1})'.format(name, attempts))
-            try:
-                boto_elasticsearch.update_elasticsearch_domain_config(
-                DomainName=name,
-                AccessPolicies=json.dumps(access_policy)
-                )
-                break
-            except Exception as e:
-                attempts += 1
-                if attempts > 3:
-                    print('Failed to apply access policies. Please run this script again with `-a delete -n {0}`'
-                          'and wait approx 20 minutes before trying again'.format(name))
-                    print('Full error was: {0}'.format(e))
-                    exit(1)
-                else:
-                    time.sleep(2)
-
     except Exception as e:
         print('Could not create elasticsearch domain: {0}.'.format(name))
         print('Error was: {0}'.format(e))
         exit(1)
 
-    while True:
+
+def apply_access_policy(name, account_id, boto_elasticsearch, lambda_role, cidr):
+    """
+    Allows the lambda role, and anything in the provided CIDR block, to access the Elastic Search Domain
+
+    """
+
+    resource = "arn:aws:es:{0}:{1}:domain/{2}/*".format(boto_elasticsearch.meta.region_name, account_id, name)
+
+    access_policy = {"Version": "2012-10-17", "Statement": [
+        {"Effect": "Allow", "Principal": {"AWS": str(lambda_role)}, "Action": "es:*", "Resource": resource},
+        {"Effect": "Allow", "Principal": {"AWS": "*"}, "Action": "es:*", "Resource": resource,
+         "Condition": {"IpAddress": {"aws:SourceIp": "{0}".format(cidr)}}}
+    ]}
+
+    print('Applying access policies to elasticsearch domain: {0}'.format(name))
+    try:
+        # The policy is rejected until the new lambda role is visible to the elasticsearch service
+        call_when_ready(boto_elasticsearch.update_elasticsearch_domain_config,
+                        'access policies for {0}'.format(name), timeout=60,
+                        DomainName=name, AccessPolicies=json.dumps(access_policy))
+    except Exception as e:
+        print('Failed to apply access policies. Please run this script again with `-a delete -n {0}`'
+              'and wait approx 20 minutes before trying again'.format(name))
+        print('Full error was: {0}'.format(e))
+        exit(1)
+
+
+def wait_for_domain(name, boto_elasticsearch, timeout=DEFAULT_DOMAIN_TIMEOUT, interval=DEFAULT_WAIT_INTERVAL,
+                    max_interval=DEFAULT_MAX_WAIT_INTERVAL, backoff=DEFAULT_WAIT_BACKOFF, jitter=DEFAULT_WAIT_JITTER):
+    """
+    Waits for an Elastic Search Domain to finish processing and for its endpoint to accept connections
+    :param timeout: The number of seconds to wait before giving up
+    :param interval: The number of seconds to wait before checking again for the first time
+    :param max_interval: The most number of seconds to wait between checks
+    :param backoff: How much to multiply the wait by after each check
+    :param jitter: The fraction of each wait to randomly add or remove, so many waiters don't check in step
+    :return: The endpoint of the domain
+    """
+
+    def domain_endpoint():
         try:
-            es_status = boto_elasticsearch.describe_elasticsearch_domain(DomainName=name)
-            processing = es_status['DomainStatus']['Processing']
+            status = boto_elasticsearch.describe_elasticsearch_domain(DomainName=name)['DomainStatus']
+        except Exception as e:
+            return None, 'could not be described ({0})'.format(e)
 
-            if not processing:
-                endpoint = es_status['DomainStatus']['Endpoint']
-                print('Domain: {0} has been created!'.format(name))
-                break
-            else:
-                print('Domain: {0} is still processing. Waiting for 120 seconds before checking again'.format(name))
-                time.sleep(120)
-
-        except Exception:
-            print('Domain: {0} is still processing. Waiting for 120 seconds before checking again'.format(name))
-            total_time += 120
-            if total_time > 1800:
-                print('Script has been running for over 30 minutes... This likely means that your elastic search domain'
-                      ' has not created successfully. Please check the Elasticsearch Service dashboard in AWS console'
-                      ' and delete the domain named {0} if it exists before trying again'.format(name))
-                exit(1)
-            time.sleep(120)
+        if status['Processing'] or not status.get('Endpoint'):
+            return None, 'is still processing'
+
+        # The domain can report that it has finished before its endpoint is resolvable
+        if not endpoint_reachable(status['Endpoint']):
+            return None, 'has finished processing but its endpoint is not reachable yet'
 
+        return status['Endpoint'], None
+
+    try:
+        endpoint = wait_until(domain_endpoint, 'Domain: {0}'.format(name), timeout, interval, max_interval,
+                              backoff, jitter)
+    except RuntimeError:
+        print('Script has waited over {0} minutes... This likely means that your elastic search domain'
+              ' has not created successfully. Please check the Elasticsearch Service dashboard in AWS console'
+              ' and delete the domain named {1} if it exists before trying again'.format(timeout // 60, name))
+        exit(1)
+
+    print('Domain: {0} has been created!'.format(name))
     return endpoint
 
 
-def configure_kibana(endpoint):
+def endpoint_reachable(endpoint):
     """
-    Configures kibana
-    and Invokes the lambda function for the first time
+    Checks that an elasticsearch endpoint accepts connections. Any response, including access denied, counts.
+    :return: True if the endpoint responded
     """
 
-    for file in os.listdir('./template_mappings'):
-        with open('./template_mappings/{0}'.format(file)) as data_file:
-            data = json.load(data_file)
-            template_name = data['template']
-            index_pattern = {"title": template_name, "timeFieldName": "timestamp"}
+    try:
+        requests.get('https://{0}/'.format(endpoint), timeout=10)
+    except requests.exceptions.RequestException:
+        return False
+
+    return True
 
-            print('Deleting any non-formated events that have arrived for {0}'.format(template_name))
-            requests.delete('https://{0}/{1}'.format(endpoint, template_name))
 
-            print('Creating a data template to format data for: {0}'.format(template_name))
-            requests.put('https://{0}/_template/{1}'.format(endpoint, template_name), data=json.dumps(data))
+def wait_until(check, description, timeout=DEFAULT_DOMAIN_TIMEOUT, interval=DEFAULT_WAIT_INTERVAL,
+               max_interval=DEFAULT_MAX_WAIT_INTERVAL, backoff=DEFAULT_WAIT_BACKOFF, jitter=DEFAULT_WAIT_JITTER):
+    """
+    Calls check until it returns a result, waiting longer between each call.
+    :param check: A function returning a tuple of the result, or None if not ready, and the reason it is not ready
+    :param description: What is being waited for, used in progress messages
+    :param timeout: The number of seconds to wait before giving up
+    :param interval: The number of seconds to wait before checking again for the first time
+    :param max_interval: The most number of seconds to wait between checks
+    :param backoff: How much to multiply the wait by after each check
+    :param jitter: The fraction of each wait to randomly add or remove
+    :return: The result of check
+    """
 
-            print('Creating index-pattern called {0} to capture incoming metrics for that index'.format(template_name))
-            requests.put('https://{0}/.kibana-4/index-pattern/{1}'.format(endpoint, template_name),
-                         data=json.dumps(index_pattern))
+    started = time.time()
+    deadline = started + timeout
 
-    default_index = {
-        "defaultIndex": "cw-*"
-    }
+    while True:
+        result, reason = check()
+        if result is not None:
+            return result
 
-    # The below doesn't appear to work for some reason.
-    print('Designating cw-* as the default index pattern')
-    requests.put('https://{0}/.kibana-4/config/4.1.2'.format(endpoint), data=json.dumps(default_index))
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise RuntimeError('{0} was not ready after {1} seconds'.format(description, timeout))
 
-    print('Kibana has been configured!')
+        wait = min(interval * random.uniform(1 - jitter, 1 + jitter), max_interval, remaining)
+        print('{0} {1} after {2:.0f} seconds. Checking again in {3:.0f} seconds'
+              .format(description, reason, time.time() - started, wait))
+        time.sleep(wait)
+        interval = min(interval * backoff, max_interval)
 
 
-def delete_lambda_functions(name, boto_session):
+def call_when_ready(func, description, retry_on=(), timeout=120, **kwargs):
     """
-    Deletes lambda functions and cloudwatch rules in ./lambdas
+    Calls an AWS api function, retrying with an increasing delay while the resources it depends on
+    are still becoming ready (eg. a new IAM role that hasn't propagated yet).
+    :param func: The boto3 client method to call
+    :param description: What is being waited for, used in progress messages
+    :param retry_on: Strings identifying the errors that mean "not ready yet". If empty, any error is retried
+    :param timeout: The number of seconds to keep retrying for
+    :param kwargs: The arguments to pass to func
+    :return: The response of the call
     """
-    for file in os.listdir('./lambdas'):
-        del_name = '{0}_{1}'.format(name, file)
 
-        # Delete Cloudwatch objects
-        print('Deleting Cloudwatch rule: {0}'.format(del_name))
+    deadline = time.time() + timeout
+    delay = 1
+
+    while True:
         try:
-            boto_cloudwatch = boto_session.client('events')
-            boto_cloudwatch.remove_targets(Rule=del_name, Ids=['0'])
-            boto_cloudwatch.delete_rule(Name=del_name)
+            return func(**kwargs)
         except Exception as e:
-            if 'ResourceNotFoundException' not in str(e):
-                print(e)
-            else:
-                print('Cloudwatch rule {0} did not exist, going ahead with other deletions'.format(del_name))
+            if retry_on and not any(error in str(e) for error in retry_on):
+                raise
+            if time.time() + delay > deadline:
+                raise
+            print('Waiting for {0} to be ready, trying again in {1} seconds'.format(description, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, 10)
+
 
-        # Delete Lambda objects
-        print('Deleting Lambda function: {0}'.format(del_name))
+def run_pipeline(steps, workers=4):
+    """
+    Runs a set of steps, starting each one as soon as the steps it depends on have finished,
+    so independent steps run at the same time.
+    :param steps: A dict of step name to a tuple of (function, list of the names of the steps it depends on).
+    Each function is called with a dict of the results of the steps that have finished.
+    :param workers: The maximum number of steps to run at once
+    :return: A dict of step name to the result of that step
+    """
+
+    results = {}
+    timings = {}
+    started = {}
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(results) < len(steps):
+            for step, (func, dependencies) in steps.items():
+                if step not in started and all(dependency in results for dependency in dependencies):
+                    started[step] = time.time()
+                    running[executor.submit(func, dict(results))] = step
+
+            if not running:
+                raise RuntimeError('Steps {0} depend on steps that do not exist'
+                                   .format(', '.join(sorted(set(steps) - set(results)))))
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                results[step] = future.result()
+                timings[step] = time.time() - started[step]
+
+    print('Time taken by each step:')
+    for step in sorted(timings, key=lambda step: started[step]):
+        print('  {0}: {1:.1f} seconds'.format(step, timings[step]))
+
+    return results
+
+
+def configure_kibana(endpoint, new_domain=False, workers=DEFAULT_DEPLOY_WORKERS):
+    """
+    Configures kibana, applying the templates and index patterns in ./template_mappings at the same time.
+    Templates that are already up to date are skipped, so this can be run again against an existing domain.
+    :param new_domain: Whether the domain has just been created, see apply_template
+    :param workers: The maximum number of templates to apply at once
+    """
+
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(apply_template, session, endpoint, file, new_domain): file
+                   for file in sorted(os.listdir('./template_mappings'))}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print('Could not apply the template in {0}'.format(futures[future]))
+                print('Error was: {0}'.format(e))
+                failed.append(futures[future])
+
+    try:
+        set_default_index_pattern(session, endpoint, 'cw-*')
+    except Exception as e:
+        print('Could not designate cw-* as the default index pattern')
+        print('Error was: {0}'.format(e))
+        failed.append('the default index pattern')
+
+    if failed:
+        print('Failed to configure {0}. Please run this script again with `-a update --kibana` to try again'
+              .format(', '.join(failed)))
+        exit(1)
+
+    print('Kibana has been configured!')
+
+
+def apply_template(session, endpoint, file, new_domain=False):
+    """
+    Applies a template from ./template_mappings and creates an index pattern for it.
+    A hash of the file is stored in the template's mapping, and the template is skipped if it is unchanged.
+    :param new_domain: Whether the domain has just been created. Only then are indices matching the template
+    deleted before it is first applied, as any events in them arrived unformatted
+    """
+
+    with open('./template_mappings/{0}'.format(file), 'rb') as data_file:
+        raw = data_file.read()
+
+    data = json.loads(raw.decode('utf-8'))
+    template_name = data['template']
+    template_hash = hashlib.sha256(raw).hexdigest()
+    data['mappings'].setdefault('_default_', {}).setdefault('_meta', {})['template_hash'] = template_hash
+
+    response = kibana_request(session, 'GET', 'https://{0}/_template/{1}'.format(endpoint, template_name),
+                              allowed_statuses=[404])
+    stored = response.json().get(template_name) if response.status_code == 200 else None
+
+    if stored is None and new_domain:
+        # On an existing domain a missing template doesn't mean its indices are unformatted, and they hold real data
+        print('Deleting any non-formated events that have arrived for {0}'.format(template_name))
+        kibana_request(session, 'DELETE', 'https://{0}/{1}'.format(endpoint, template_name), allowed_statuses=[404])
+
+    stored_hash = (stored or {}).get('mappings', {}).get('_default_', {}).get('_meta', {}).get('template_hash')
+    if stored_hash == template_hash:
+        print('The data template for {0} is already up to date'.format(template_name))
+    else:
+        print('Creating a data template to format data for: {0}'.format(template_name))
+        kibana_request(session, 'PUT', 'https://{0}/_template/{1}'.format(endpoint, template_name),
+                       data=json.dumps(data))
+
+    # Creating rather than overwriting the index pattern keeps any fields kibana has since added to it
+    print('Creating index-pattern called {0} to capture incoming metrics for that index'.format(template_name))
+    index_pattern = {"title": template_name, "timeFieldName": "timestamp"}
+    kibana_request(session, 'PUT', 'https://{0}/{1}/index-pattern/{2}?op_type=create'
+                   .format(endpoint, KIBANA_INDEX, template_name),
+                   data=json.dumps(index_pattern), allowed_statuses=[409])
+
+
+def set_default_index_pattern(session, endpoint, index_pattern):
+    """
+    Designates the default index pattern in kibana's config. The config document is named after the version
+    of kibana, so the one kibana has saved is updated, or DEFAULT_KIBANA_VERSION's if kibana hasn't saved one yet.
+    """
+
+    print('Designating {0} as the default index pattern'.format(index_pattern))
+
+    response = kibana_request(session, 'GET', 'https://{0}/{1}/config/_search?size=1'.format(endpoint, KIBANA_INDEX),
+                              allowed_statuses=[404])
+    hits = response.json().get('hits', {}).get('hits', []) if response.status_code == 200 else []
+    version = hits[0]['_id'] if hits else DEFAULT_KIBANA_VERSION
+
+    kibana_request(session, 'POST', 'https://{0}/{1}/config/{2}/_update'.format(endpoint, KIBANA_INDEX, version),
+                   data=json.dumps({"doc": {"defaultIndex": index_pattern}, "doc_as_upsert": True}))
+
+
+def kibana_request(session, method, url, data=None, allowed_statuses=(), retries=DEFAULT_BOOTSTRAP_RETRIES):
+    """
+    Makes a request to the elasticsearch domain, retrying connection errors and responses
+    that mean the domain is busy, with an increasing delay.
+    :param allowed_statuses: Error statuses that are expected, and returned rather than raised
+    :return: The response
+    """
+
+    delay = 1
+
+    for attempt in range(retries + 1):
         try:
-            boto_lambda = boto_session.client('lambda')
-            boto_lambda.delete_function(FunctionName=del_name)
-        except Exception as e:
-            if 'ResourceNotFoundException' not in str(e):
+            response = session.request(method, url, data=data, timeout=30)
+            if response.status_code not in RETRY_STATUSES:
+                break
+        except requests.exceptions.ConnectionError:
+            if attempt == retries:
+                raise
+        if attempt < retries:
+            time.sleep(delay)
+            delay *= 2
+
+    if response.status_code >= 400 and response.status_code not in allowed_statuses:
+        raise RuntimeError('{0} {1} returned {2}: {3}'.format(method, url, response.status_code, response.text))
+
+    return response
+
+
+def delete_lambda_functions(name, boto_lambda, boto_cloudwatch, workers=DEFAULT_DEPLOY_WORKERS):
+    """
+    Deletes the lambda functions and cloudwatch rules of an elk stack at the same time. They are found by listing
+    everything named for the stack, so those whose folders have since been removed from ./lambdas are deleted too.
+    :param workers: The maximum number of lambda functions and rules to delete at once
+    """
+
+    prefix = '{0}_'.format(name)
+    role_suffix = ':role/{0}_processing_lambda_role'.format(name)
+    folders = os.listdir('./lambdas') if os.path.isdir('./lambdas') else []
+
+    # Other stacks can share the prefix (eg. elk and elk_test), so functions must also match a folder or the role
+    functions = [
+        function['FunctionName']
+        for page in boto_lambda.get_paginator('list_functions').paginate()
+        for function in page['Functions']
+        if function['FunctionName'].startswith(prefix)
+        and (function['FunctionName'][len(prefix):] in folders or function['Role'].endswith(role_suffix))
+    ]
+    rules = [
+        rule['Name']
+        for page in boto_cloudwatch.get_paginator('list_rules').paginate(NamePrefix=prefix)
+        for rule in page['Rules']
+        if rule['Name'] in functions or rule['Name'][len(prefix):] in folders
+    ]
+
+    print('Deleting {0} Cloudwatch rules and {1} Lambda functions'.format(len(rules), len(functions)))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(delete_rule, rule, boto_cloudwatch) for rule in rules]
+        futures += [executor.submit(delete_function, function, boto_lambda) for function in functions]
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
                 print(e)
-            else:
-                print('Lambda function {0} did not exist, going ahead with other deletions'.format(del_name))
 
 
+def delete_rule(rule, boto_cloudwatch):
+    """
+    Deletes a cloudwatch rule, after removing its targets
+    """
+
+    print('Deleting Cloudwatch rule: {0}'.format(rule))
+    try:
+        target_ids = [target['Id']
+                      for page in boto_cloudwatch.get_paginator('list_targets_by_rule').paginate(Rule=rule)
+                      for target in page['Targets']]
+        if target_ids:
+            boto_cloudwatch.remove_targets(Rule=rule, Ids=target_ids)
+
+        # A rule can't be deleted until the removal of its targets has been applied
+        call_when_ready(boto_cloudwatch.delete_rule, 'the Cloudwatch rule {0}'.format(rule),
+                        retry_on=['has targets'], Name=rule)
+    except boto_cloudwatch.exceptions.ResourceNotFoundException:
+        print('Cloudwatch rule {0} did not exist, going ahead with other deletions'.format(rule))
+
 
-def create_lambda_functions(esname, endpoint, boto_session, role_arn):
+def delete_function(function, boto_lambda):
     """
-    Creates lambda functions and cloudwatch schedules to run those functions from directories in ./lambdas
+    Deletes a lambda function
     """
 
-    # Wait for the IAM Role to be ready to attach
-    boto_lambda = boto_session.client('lambda')
-    region = endpoint.split('.')[1]
-    runtime = handler = description = timeout = event_rule = schedule = None
+    print('Deleting Lambda function: {0}'.format(function))
+    try:
+        boto_lambda.delete_function(FunctionName=function)
+    except boto_lambda.exceptions.ResourceNotFoundException:
+        print('Lambda function {0} did not exist, going ahead with other deletions'.format(function))
 
-    time.sleep(30)
 
-    for folder in os.listdir('./lambdas'):
+def package_lambda_functions():
+    """
+    Reads the config of each directory in ./lambdas and builds a zip file of its code in memory.
+    Zip files are cached in PACKAGE_CACHE_DIR by a hash of their source, so unchanged folders aren't zipped again.
+    :return: A dict of folder name to a dict of the folder's 'config', its 'zip' file contents,
+    and the 'code_sha256' of the zip file as lambda reports it
+    """
+
+    packages = {}
+
+    for folder in sorted(os.listdir('./lambdas')):
         try:
             with open('./lambdas/{0}/lambda_config.json'.format(folder)) as data_file:
                 config = json.load(data_file)
-                runtime = config['runtime']
-                handler = config['handler']
-                description = config['description']
-                timeout = config['timeout']
-                event_rule = config['cloudwatch_rule']
-                schedule = config['schedule']
-
-                if 'endpoint' in event_rule:
-                    event_rule['endpoint'] = endpoint
-                if 'region' in event_rule:
-                    event_rule['region'] = region
-                if 'domainname' in event_rule:
-                    event_rule['domainname'] = esname
+                for key in ['runtime', 'handler', 'description', 'timeout', 'cloudwatch_rule', 'schedule']:
+                    config[key]
 
         except Exception as e:
             print("There is either no lambda_config.json file, or a missing config variable for {0}".format(folder))
             print("Error: {0}".format(e))
             exit(1)
 
-        for file in os.listdir('./lambdas/{0}'.format(folder)):
-            if file != 'lambda_config.json':
-                file_details = file.split('.')
-
-                zip_file = zipfile.ZipFile('{0}_{1}.zip'.format(esname, file_details[0]), 'w')
-                zip_file.write('./lambdas/{0}/{1}'.format(folder, file), './{0}'.format(file))
-                zip_file.close()
-
-                print('Creating a lambda function: \'{0}_{1}\' using the local file \'{2}\''
-                      .format(esname, folder, file))
-
-                with open('{0}_{1}.zip'.format(esname, file_details[0]), 'rb') as zfile:
-                    response = boto_lambda.create_function(
-                        FunctionName='{0}_{1}'.format(esname, folder),
-                        Runtime=runtime,
-                        Role=role_arn,
-                        Handler=handler,
-                        Code={
-                            'ZipFile': zfile.read()
-                        },
-                        Description=description,
-                        Timeout=timeout
-                    )
-
-                lambda_arn = response['FunctionArn']
-
-                print('Updating lambda permissions to allow events.amazonaws.com to invoke the function')
-
-                boto_lambda.add_permission(
-                    FunctionName=lambda_arn,
-                    StatementId='0',
-                    Action='lambda:InvokeFunction',
-                    Principal='events.amazonaws.com'
-                )
-
-                boto_cloudwatch = boto_session.client('events')
-
-                print('Creating a Cloudwatch rule \'{0}_{1}\''.format(esname, folder))
-                boto_cloudwatch.put_rule(
-                    Name='{0}_{1}'.format(esname, folder),
-                    ScheduleExpression=schedule,
-                    State='ENABLED',
-                    Description='runs lambda function: {0}_{1} on schedule: {2}'.format(esname, folder, schedule)
-                )
-
-                print('Creating a target for the Cloudwatch rule, pointing it at the lambda function')
-                boto_cloudwatch.put_targets(
-                    Rule='{0}_{1}'.format(esname, folder),
-                    Targets=[
-                        {
-                            'Id': '0',
-                            'Arn': lambda_arn,
-                            'Input': json.dumps(event_rule),
-                        }
-                    ]
-                )
-
-    print('Removing zip files that have been created during execution')
-
-    for file in os.listdir('.'):
-        if file.split('.')[-1] == 'zip':
-            os.remove(file)
-
-
-def create_lambda_iam_role(name, boto_session):
+        files = [(file, './lambdas/{0}/{1}'.format(folder, file))
+                 for file in sorted(os.listdir('./lambdas/{0}'.format(folder)))
+                 if file != 'lambda_config.json' and not file.endswith(UNPACKAGED_SUFFIXES)
+                 and os.path.isfile('./lambdas/{0}/{1}'.format(folder, file))]
+
+        # Python lambdas share modules, such as the elasticsearch client, that are packaged alongside each one
+        if config['runtime'].startswith('python'):
+            files += [(file, '{0}/{1}'.format(SHARED_MODULES_DIR, file))
+                      for file in sorted(os.listdir(SHARED_MODULES_DIR)) if file.endswith('.py')]
+
+        zip_data = build_package(folder, files)
+
+        packages[folder] = {
+            'config': config,
+            'zip': zip_data,
+            'code_sha256': base64.b64encode(hashlib.sha256(zip_data).digest()).decode('utf-8')
+        }
+
+    return packages
+
+
+def build_package(folder, files):
     """
-    Creates IAM Policy and Role to attach to the lambda function to handle cloudwatch metrics
+    Builds the zip file for a lambda function, or reads it from the cache if its source hasn't changed.
+    Every file is given the same timestamp so the same source always builds an identical zip file.
+    :param folder: The folder in ./lambdas that is being packaged
+    :param files: A list of tuples of the name of each file in the zip file and the path to read it from
+    :return: The contents of the zip file
+    """
+
+    contents = []
+    source_hash = hashlib.sha256()
+    for name, path in files:
+        with open(path, 'rb') as source_file:
+            data = source_file.read()
+        contents.append((name, data))
+        source_hash.update(name.encode('utf-8') + b'\0' + data + b'\0')
+
+    cache_path = '{0}/{1}_{2}.zip'.format(PACKAGE_CACHE_DIR, folder, source_hash.hexdigest())
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cached_file:
+            return cached_file.read()
+
+    print('Packaging the local folder \'./lambdas/{0}\''.format(folder))
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in contents:
+            info = zipfile.ZipInfo(name, ZIP_DATE_TIME)
+            info.external_attr = 0o644 << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            zip_file.writestr(info, data)
+    zip_data = buffer.getvalue()
+
+    try:
+        os.makedirs(PACKAGE_CACHE_DIR, exist_ok=True)
+        with open(cache_path + '.tmp', 'wb') as cached_file:
+            cached_file.write(zip_data)
+        os.replace(cache_path + '.tmp', cache_path)
+    except OSError as e:
+        print('Could not cache the package for {0}, it will be built again next time'.format(folder))
+        print('Error was: {0}'.format(e))
+
+    return zip_data
+
 
+def lambda_event_input(esname, endpoint, config):
+    """
+    :return: The input the cloudwatch rule passes to a lambda function, filled in with the details of the domain
     """
 
-    boto_iam = boto_session.client('iam')
+    event_rule = dict(config['cloudwatch_rule'])
 
-    policy_document = {
-        "Version": "2012-10-17",
-        "Statement": [
-            {
-                "Effect": "Allow",
-                "Action": [
-                    "ec2:DescribeInstances",
-                    "ec2:DescribeVolumes",
-                    "rds:DescribeDBInstances",
-                    "sts:AssumeRole",
-                    "cloudwatch:GetMetricStatistics",
-                    "es:*",
-                    "s3:*"
-                ],
-                "Resource": "*"
+    if 'endpoint' in event_rule:
+        event_rule['endpoint'] = endpoint
+    if 'region' in event_rule:
+        event_rule['region'] = endpoint.split('.')[1]
+    if 'domainname' in event_rule:
+        event_rule['domainname'] = esname
+
+    return event_rule
+
+
+def create_lambda_functions(esname, endpoint, boto_lambda, boto_cloudwatch, role_arn, packages=None,
+                            workers=DEFAULT_DEPLOY_WORKERS):
+    """
+    Creates lambda functions and cloudwatch schedules to run those functions from directories in ./lambdas.
+    The lambda functions are deployed at the same time.
+    :param packages: The packaged lambda functions, as returned by package_lambda_functions.
+    If not provided, the lambda functions are packaged first.
+    :param workers: The maximum number of lambda functions to deploy at once
+    """
+
+    if packages is None:
+        packages = package_lambda_functions()
+
+    deploy_concurrently(deploy_lambda_function, esname, packages, workers,
+                        endpoint, role_arn, boto_lambda, boto_cloudwatch)
+
+
+def update_lambda_functions(esname, endpoint, boto_lambda, boto_cloudwatch, role_arn, packages=None,
+                            workers=DEFAULT_DEPLOY_WORKERS):
+    """
+    Updates the lambda functions and cloudwatch schedules of directories in ./lambdas, only changing
+    the parts of each one that differ from what is deployed. Lambda functions that don't exist yet are created.
+    :param packages: The packaged lambda functions, as returned by package_lambda_functions.
+    If not provided, the lambda functions are packaged first.
+    :param workers: The maximum number of lambda functions to update at once
+    """
+
+    if packages is None:
+        packages = package_lambda_functions()
+
+    changes = deploy_concurrently(update_lambda_function, esname, packages, workers,
+                                  endpoint, role_arn, boto_lambda, boto_cloudwatch)
+
+    for folder in sorted(changes):
+        print('{0}_{1}: {2}'.format(esname, folder, ', '.join(changes[folder]) or 'no changes'))
+
+
+def deploy_concurrently(deploy, esname, packages, workers, *args):
+    """
+    Runs a deploy function for each lambda package at the same time, exiting if any of them fail.
+    :param deploy: The function to run. It is called with esname, the folder name, its package and args.
+    :return: A dict of folder name to what the deploy function returned
+    """
+
+    results = {}
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(deploy, esname, folder, packages[folder], *args): folder
+                   for folder in sorted(packages)}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                print('Could not deploy the lambda function: \'{0}_{1}\''.format(esname, futures[future]))
+                print('Error was: {0}'.format(e))
+                failed.append(futures[future])
+
+    if failed:
+        print('Failed to deploy {0}. Please fix the errors above and run this script again with `-a update`'
+              .format(', '.join(sorted(failed))))
+        exit(1)
+
+    return results
+
+
+def deploy_lambda_function(esname, folder, package, endpoint, role_arn, boto_lambda, boto_cloudwatch):
+    """
+    Creates a lambda function and the cloudwatch rule that runs it on a schedule.
+    If the lambda function already exists, its code is only uploaded again if it has changed.
+    """
+
+    config = package['config']
+    function_name = '{0}_{1}'.format(esname, folder)
+    schedule = config['schedule']
+
+    print('Creating a lambda function: \'{0}\' using the local folder \'./lambdas/{1}\''.format(function_name, folder))
+
+    try:
+        # A new IAM role takes a few seconds before lambda is able to assume it
+        response = call_when_ready(
+            boto_lambda.create_function, 'the IAM role {0}'.format(role_arn),
+            retry_on=['cannot be assumed by Lambda'],
+            FunctionName=function_name,
+            Runtime=config['runtime'],
+            Role=role_arn,
+            Handler=config['handler'],
+            Code={
+                'ZipFile': package['zip']
             },
+            Description=config['description'],
+            Timeout=config['timeout']
+        )
+    except boto_lambda.exceptions.ResourceConflictException:
+        response = boto_lambda.get_function_configuration(FunctionName=function_name)
+        if response['CodeSha256'] == package['code_sha256']:
+            print('Lambda function \'{0}\' already exists with the same code, not uploading it'.format(function_name))
+        else:
+            print('Lambda function \'{0}\' already exists, uploading its new code'.format(function_name))
+            boto_lambda.update_function_code(FunctionName=function_name, ZipFile=package['zip'])
+
+    lambda_arn = response['FunctionArn']
+
+    print('Updating lambda permissions to allow events.amazonaws.com to invoke the function')
+
+    try:
+        boto_lambda.add_permission(
+            FunctionName=lambda_arn,
+            StatementId='0',
+            Action='lambda:InvokeFunction',
+            Principal='events.amazonaws.com'
+        )
+    except boto_lambda.exceptions.ResourceConflictException:
+        print('Lambda function \'{0}\' can already be invoked by events.amazonaws.com'.format(function_name))
+
+    print('Creating a Cloudwatch rule \'{0}\''.format(function_name))
+    boto_cloudwatch.put_rule(
+        Name=function_name,
+        ScheduleExpression=schedule,
+        State='ENABLED',
+        Description='runs lambda function: {0} on schedule: {1}'.format(function_name, schedule)
+    )
+
+    print('Creating a target for the Cloudwatch rule, pointing it at the lambda function')
+    boto_cloudwatch.put_targets(
+        Rule=function_name,
+        Targets=[
             {
-                "Effect": "Allow",
-                "Action": [
-                    "logs:CreateLogGroup",
-                    "logs:CreateLogStream",
-                    "logs:PutLogEvents"
-                ],
-                "Resource": "arn:aws:logs:*:*:*"
+                'Id': '0',
+                'Arn': lambda_arn,
+                'Input': json.dumps(lambda_event_input(esname, endpoint, config)),
             }
         ]
+    )
+
+
+def update_lambda_function(esname, folder, package, endpoint, role_arn, boto_lambda, boto_cloudwatch):
+    """
+    Compares a lambda function and its cloudwatch rule against the local package, and only updates what differs.
+    :return: A list of what was changed
+    """
+
+    config = package['config']
+    function_name = '{0}_{1}'.format(esname, folder)
+    schedule = config['schedule']
+    event_input = lambda_event_input(esname, endpoint, config)
+    changes = []
+
+    try:
+        deployed = boto_lambda.get_function_configuration(FunctionName=function_name)
+    except boto_lambda.exceptions.ResourceNotFoundException:
+        deploy_lambda_function(esname, folder, package, endpoint, role_arn, boto_lambda, boto_cloudwatch)
+        return ['created']
+
+    settings = {
+        'Runtime': config['runtime'],
+        'Role': role_arn,
+        'Handler': config['handler'],
+        'Description': config['description'],
+        'Timeout': config['timeout']
     }
+    changed_settings = dict((key, value) for key, value in settings.items() if deployed.get(key) != value)
+
+    # Lambda rejects changes to a function while an earlier change to it is still being applied
+    if changed_settings:
+        print('Updating the configuration of lambda function \'{0}\': {1}'
+              .format(function_name, ', '.join(sorted(changed_settings))))
+        call_when_ready(boto_lambda.update_function_configuration, 'lambda function {0}'.format(function_name),
+                        retry_on=['update is in progress'], FunctionName=function_name, **changed_settings)
+        changes.append('configuration')
+
+    if deployed['CodeSha256'] != package['code_sha256']:
+        print('Uploading the new code of lambda function \'{0}\''.format(function_name))
+        call_when_ready(boto_lambda.update_function_code, 'lambda function {0}'.format(function_name),
+                        retry_on=['update is in progress'], FunctionName=function_name, ZipFile=package['zip'])
+        changes.append('code')
+
+    try:
+        rule = boto_cloudwatch.describe_rule(Name=function_name)
+    except boto_cloudwatch.exceptions.ResourceNotFoundException:
+        rule = {}
+
+    if rule.get('ScheduleExpression') != schedule or rule.get('State') != 'ENABLED':
+        print('Updating the Cloudwatch rule \'{0}\''.format(function_name))
+        boto_cloudwatch.put_rule(
+            Name=function_name,
+            ScheduleExpression=schedule,
+            State='ENABLED',
+            Description='runs lambda function: {0} on schedule: {1}'.format(function_name, schedule)
+        )
+        changes.append('schedule')
+
+    targets = boto_cloudwatch.list_targets_by_rule(Rule=function_name)['Targets'] if rule else []
+    target = dict((target['Id'], target) for target in targets).get('0', {})
+
+    if target.get('Arn') != deployed['FunctionArn'] or json.loads(target.get('Input') or 'null') != event_input:
+        print('Updating the target of the Cloudwatch rule \'{0}\''.format(function_name))
+        boto_cloudwatch.put_targets(
+            Rule=function_name,
+            Targets=[
+                {
+                    'Id': '0',
+                    'Arn': deployed['FunctionArn'],
+                    'Input': json.dumps(event_input),
+                }
+            ]
+        )
+        changes.append('rule input')
+
+    return changes
+
+
+def create_lambda_iam_role(name, boto_iam):
+    """
+    Creates IAM Policy and Role to attach to the lambda function to handle cloudwatch metrics
+
+    """
 
     assumerole_document = {
         "Version": "2012-10-17",
@@ -314,7 +830,7 @@ def create_lambda_iam_role(name, boto_session):
     print('Creating IAM Policy \'{0}_processing_lambda_policy\' to enable access to cloudwatch metrics'.format(name))
     policy = boto_iam.create_policy(
         PolicyName='{0}_processing_lambda_policy'.format(name),
-        PolicyDocument=json.dumps(policy_document),
+        PolicyDocument=json.dumps(LAMBDA_POLICY_DOCUMENT),
         Description='Iam Policy created for elasticsearch domain \'{0}\' that should give access to process cloudwatch'
                     ' metrics to a lambda function'.format(name)
     )
@@ -333,48 +849,116 @@ def create_lambda_iam_role(name, boto_session):
 
     return role['Role']['Arn']
 
+
+def update_lambda_iam_policy(name, boto_iam):
+    """
+    Brings the IAM policy of an elk stack up to date with LAMBDA_POLICY_DOCUMENT, so lambda functions that
+    need new permissions (eg. cloudwatch:GetMetricData) keep working once they are updated. A new default version
+    of the policy is only created if its permissions differ, removing the oldest version if IAM's limit is reached.
+    """
+
+    policy_name = '{0}_processing_lambda_policy'.format(name)
+
+    policies = [policy
+                for page in boto_iam.get_paginator('list_policies').paginate(Scope='Local')
+                for policy in page['Policies']
+                if policy['PolicyName'] == policy_name]
+
+    if not policies:
+        print('IAM Policy {0} does not exist, so it was not updated. Make sure the role used by the lambda functions '
+              'allows every action in LAMBDA_POLICY_DOCUMENT in elk.py'.format(policy_name))
+        return
+
+    policy_arn = policies[0]['Arn']
+    document = boto_iam.get_policy_version(PolicyArn=policy_arn,
+                                           VersionId=policies[0]['DefaultVersionId'])['PolicyVersion']['Document']
+    if not isinstance(document, dict):
+        document = json.loads(urllib.parse.unquote(document))
+
+    if document == LAMBDA_POLICY_DOCUMENT:
+        print('IAM Policy {0} is up to date'.format(policy_name))
+        return
+
+    versions = boto_iam.list_policy_versions(PolicyArn=policy_arn)['Versions']
+    if len(versions) >= MAX_POLICY_VERSIONS:
+        oldest = min((version for version in versions if not version['IsDefaultVersion']),
+                     key=lambda version: version['CreateDate'])
+        boto_iam.delete_policy_version(PolicyArn=policy_arn, VersionId=oldest['VersionId'])
+
+    print('Updating IAM Policy {0} with the permissions the lambda functions now need'.format(policy_name))
+    boto_iam.create_policy_version(PolicyArn=policy_arn, PolicyDocument=json.dumps(LAMBDA_POLICY_DOCUMENT),
+                                   SetAsDefault=True)
+
+
 def delete_elk(name, boto_session):
     """
-    Deletes an elk environment with the specified name
+    Deletes an elk environment with the specified name. The lambda functions, IAM objects and
+    elasticsearch domain don't depend on each other, so they are deleted at the same time.
+
+    """
+
+    # Each deletion runs on its own thread, and boto3 sessions can't be shared between threads
+    boto_lambda = boto_session.client('lambda')
+    boto_cloudwatch = boto_session.client('events')
+    boto_iam = boto_session.client('iam')
+    boto_elasticsearch = boto_session.client('es')
+
+    run_pipeline({
+        'delete lambda functions': (lambda results: delete_lambda_functions(name, boto_lambda, boto_cloudwatch), []),
+        'delete iam objects': (lambda results: delete_iam_objects(name, boto_iam), []),
+        'delete elasticsearch domain': (lambda results: delete_elasticsearch_domain(name, boto_elasticsearch), [])
+    })
+
+    print('All Elk objects for: \'{0}\' have been deleted'.format(name))
 
+
+def delete_iam_objects(name, boto_iam):
+    """
+    Deletes the IAM role and policy of an elk stack, detaching any policies from the role first
     """
-    delete_lambda_functions(name, boto_session)
 
-    # Delete IAM objects
     role_name = '{0}_processing_lambda_role'.format(name)
     policy_name = '{0}_processing_lambda_policy'.format(name)
 
-    policy_arn = 'NO POLICY FOUND IN SEARCH'
+    print('Deleting iam objects: {0} and {1}'.format(role_name, policy_name))
+
+    # Only policies created in this account are listed, which is far fewer pages than every AWS managed policy
+    policy_arns = [policy['Arn']
+                   for page in boto_iam.get_paginator('list_policies').paginate(Scope='Local')
+                   for policy in page['Policies']
+                   if policy['PolicyName'] == policy_name]
 
     try:
-        boto_iam = boto_session.client('iam')
+        attached_arns = [policy['PolicyArn']
+                         for page in boto_iam.get_paginator('list_attached_role_policies').paginate(RoleName=role_name)
+                         for policy in page['AttachedPolicies']]
 
-        for policy in boto_iam.list_policies()['Policies']:
-            if policy['PolicyName'] == policy_name:
-                policy_arn = policy['Arn']
-    except Exception as e:
-        print(e)
+        for policy_arn in attached_arns:
+            boto_iam.detach_role_policy(RoleName=role_name, PolicyArn=policy_arn)
 
-    print('Deleting iam objects: {0} and {1}'.format(role_name, policy_name))
+        call_when_ready(boto_iam.delete_role, 'the IAM role {0}'.format(role_name),
+                        retry_on=['DeleteConflict'], RoleName=role_name)
+    except boto_iam.exceptions.NoSuchEntityException:
+        print('IAM Role {0} did not exist, going ahead with other deletions'.format(role_name))
 
-    try:
-        boto_iam = boto_session.client('iam')
+    if not policy_arns:
+        print('IAM Policy {0} did not exist, going ahead with other deletions'.format(policy_name))
 
-        boto_iam.detach_role_policy(RoleName=role_name,
-                                    PolicyArn=policy_arn)
-        boto_iam.delete_role(RoleName=role_name)
-        boto_iam.delete_policy(PolicyArn=policy_arn)
-    except Exception as e:
-        if 'ResourceNotFoundException' not in str(e) and 'NoSuchEntity' not in str(e):
-            print(e)
-        else:
-            print('IAM Role {0} or IAM Policy {1} did not exist, going ahead with other deletions'.format(role_name, policy_name))
+    for policy_arn in policy_arns:
+        try:
+            call_when_ready(boto_iam.delete_policy, 'the IAM policy {0}'.format(policy_name),
+                            retry_on=['DeleteConflict'], PolicyArn=policy_arn)
+        except boto_iam.exceptions.NoSuchEntityException:
+            print('IAM Policy {0} did not exist, going ahead with other deletions'.format(policy_name))
+
+
+def delete_elasticsearch_domain(name, boto_elasticsearch):
+    """
+    Deletes an elasticsearch domain
+    """
 
-    # Delete elasticsearch domain object
     print('Deleting Elasticsearch domain: {0}'.format(name))
     try:
-        boto_elasticsearch = boto_session.client('es')
-
         boto_elasticsearch.delete_elasticsearch_domain(DomainName=name)
     except Exception as e:
         if 'ResourceNotFoundException' not in str(e):
@@ -382,7 +966,6 @@ def delete_elk(name, boto_session):
         else:
             print('Elasticsearch domain {0} did not exist'.format(name))
 
-    print('All Eck objects for: \'{0}\' have been deleted'.format(name))
 
 def parse_args():
     """
@@ -399,15 +982,174 @@ def parse_args():
                         help='What name to give the elk instance. default: elk')
     parser.add_argument('-a', '--action',
                         default='create',
-                        help='The action to perform. options: create, or delete. Delete will delete all elk '
-                             'objects with the provided name (-n). default: create')
+                        help='The action to perform. options: create, update, or delete. Update will only change '
+                             'the lambda functions and schedules that differ from ./lambdas, using the role (-r), '
+                             'and brings the IAM policy of the lambda functions up to date. '
+                             'Delete will delete all elk objects with the provided name (-n). default: create')
     parser.add_argument('-r', '--role',
                         default='NOROLESPECIFIED',
                         help='ARN of role to be used for lambda functions')
+    parser.add_argument('-t', '--timeout',
+                        default=DEFAULT_DOMAIN_TIMEOUT // 60, type=int,
+                        help='How many minutes to wait for the elasticsearch domain to be created. '
+                             'default: {0}'.format(DEFAULT_DOMAIN_TIMEOUT // 60))
+    parser.add_argument('-m', '--manifest',
+                        help='A json file listing the accounts (as profiles), regions and names of a fleet of elk '
+                             'instances to perform the action on, instead of the profile (-p) and name (-n)')
+    parser.add_argument('-w', '--workers',
+                        default=DEFAULT_FLEET_WORKERS, type=int,
+                        help='How many elk instances in the manifest (-m) to perform the action on at once. '
+                             'default: {0}'.format(DEFAULT_FLEET_WORKERS))
+    parser.add_argument('-k', '--kibana',
+                        action='store_true',
+                        help='With update, also apply the templates and index patterns in ./template_mappings that '
+                             'have changed. Your IP address must be in the CIDR block allowed to access the domain')
 
     return parser.parse_args()
 
 
+def run_action(action, domainname, session, cidr=None, role=None, timeout=DEFAULT_DOMAIN_TIMEOUT, packages=None,
+               kibana=False):
+    """
+    Creates, updates or deletes an elk stack in the account and region of a boto session
+    :param action: One of CREATE, UPDATE or DELETE
+    :param cidr: The CIDR block allowed to access the elasticsearch domain, required to create
+    :param role: The ARN of the role used by the lambda functions, required to update
+    :param timeout: The number of seconds to wait for the elasticsearch domain to be created
+    :param packages: The packaged lambda functions, as returned by package_lambda_functions.
+    If not provided, the lambda functions are packaged when needed.
+    :param kibana: Whether to also apply changed templates and index patterns when updating
+    """
+
+    if action in ['CREATE']:
+        account_id = session.client('sts').get_caller_identity()['Account']
+
+        # The steps below run on other threads. boto3 clients can be shared between threads, but sessions can't,
+        # so every client they use is created here first.
+        boto_iam = session.client('iam')
+        boto_elasticsearch = session.client('es')
+        boto_lambda = session.client('lambda')
+        boto_cloudwatch = session.client('events')
+
+        # Only the lambda functions and kibana need the domain to be ready, everything else is started straight away
+        results = run_pipeline({
+            'create iam role': (lambda results: create_lambda_iam_role(domainname, boto_iam), []),
+            'package lambda functions': (lambda results: packages or package_lambda_functions(), []),
+            'create elasticsearch domain': (lambda results: create_elasticsearch_domain(
+                domainname, boto_elasticsearch), []),
+            'apply access policy': (lambda results: apply_access_policy(
+                domainname, account_id, boto_elasticsearch, results['create iam role'], cidr),
+                ['create iam role', 'create elasticsearch domain']),
+            'wait for elasticsearch domain': (lambda results: wait_for_domain(
+                domainname, boto_elasticsearch, timeout=timeout), ['apply access policy']),
+            'create lambda functions': (lambda results: create_lambda_functions(
+                domainname, results['wait for elasticsearch domain'], boto_lambda, boto_cloudwatch,
+                results['create iam role'], results['package lambda functions']),
+                ['create iam role', 'package lambda functions', 'wait for elasticsearch domain']),
+            'configure kibana': (lambda results: configure_kibana(results['wait for elasticsearch domain'],
+                                                                  new_domain=True),
+                                 ['wait for elasticsearch domain'])
+        })
+        endpoint = results['wait for elasticsearch domain']
+        print('Kibana Endpoint: \'https://{0}/_plugin/kibana/\''.format(endpoint))
+        print('elk {0} has been fully created'.format(domainname))
+    elif action in ['UPDATE']:
+        if not role or role == 'NOROLESPECIFIED':
+            raise RuntimeError("Role ARN -r/--role must be specified to update lambdas")
+
+        es = session.client('es')
+        es_status = es.describe_elasticsearch_domain(DomainName=domainname)
+        endpoint = es_status['DomainStatus']['Endpoint']
+
+        update_lambda_iam_policy(domainname, session.client('iam'))
+        update_lambda_functions(domainname, endpoint, session.client('lambda'), session.client('events'), role,
+                                packages)
+        # Kibana is reached directly, which the domain's access policy only allows from its CIDR block
+        if kibana:
+            configure_kibana(endpoint)
+    elif action in ['DELETE']:
+        delete_elk(domainname, session)
+    else:
+        raise RuntimeError('Unrecognised action {0}'.format(action))
+
+
+def load_manifest(path, action):
+    """
+    Reads a fleet manifest, which lists the accounts and regions to run an action against. eg.
+    {"defaults": {"name": "elk", "cidr": "10.0.0.0/8"},
+     "targets": [{"profile": "prod", "region": "ap-southeast-2"}, {"profile": "dev", "region": "us-east-1"}]}
+    Each target can set profile, region, name, cidr and role, and any it doesn't set are taken from defaults.
+    :return: A list of targets, with the defaults filled in
+    """
+
+    try:
+        with open(path) as manifest_file:
+            manifest = json.load(manifest_file)
+
+        targets = []
+        for target in manifest['targets']:
+            merged = {'profile': 'default', 'region': None, 'name': 'elk', 'cidr': None, 'role': None}
+            merged.update(manifest.get('defaults', {}))
+            merged.update(target)
+            targets.append(merged)
+    except Exception as e:
+        print('Could not read the fleet manifest: {0}'.format(path))
+        print('Error was: {0}'.format(e))
+        exit(1)
+
+    for target in targets:
+        if action in ['CREATE'] and not re.match(CIDR_PATTERN, target['cidr'] or ''):
+            print('Target {0} needs a cidr to create, eg. 0-255.0-255.0-255.0-255/0-32'.format(target_label(target)))
+            exit(1)
+        if action in ['UPDATE'] and not target['role']:
+            print('Target {0} needs a role to update'.format(target_label(target)))
+            exit(1)
+
+    return targets
+
+
+def target_label(target):
+    """
+    :return: A short name for a fleet target, used in progress messages and the report
+    """
+
+    return '{0}/{1}/{2}'.format(target['profile'], target['region'] or 'default region', target['name'])
+
+
+def run_fleet(action, targets, workers=DEFAULT_FLEET_WORKERS, timeout=DEFAULT_DOMAIN_TIMEOUT, kibana=False):
+    """
+    Runs an action against every target in a fleet, several at a time. A failure in one target doesn't
+    stop the others, and a report of every target is printed at the end.
+    :param targets: The targets, as returned by load_manifest
+    :param workers: The maximum number of targets to run the action against at once
+    :param kibana: Whether to also apply changed templates and index patterns when updating, see run_action
+    :return: The number of targets that failed
+    """
+
+    packages = package_lambda_functions() if action in ['CREATE', 'UPDATE'] else None
+
+    # Sessions are created up front, as creating them isn't thread safe
+    sessions = [boto3.Session(profile_name=target['profile'], region_name=target['region']) for target in targets]
+
+    def run_target(target, session):
+        started = time.time()
+        try:
+            run_action(action, target['name'], session, target['cidr'], target['role'], timeout, packages, kibana)
+            return 'succeeded', time.time() - started, ''
+        except (Exception, SystemExit) as e:
+            return 'failed', time.time() - started, str(e) if isinstance(e, Exception) else 'see the errors above'
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(run_target, targets, sessions))
+
+    print('{0} results:'.format(action.lower()))
+    for target, (status, seconds, error) in zip(targets, results):
+        print('  {0}: {1} in {2:.0f} seconds{3}'.format(target_label(target), status, seconds,
+                                                          '. Error was: {0}'.format(error) if error else ''))
+
+    return len([result for result in results if result[0] == 'failed'])
+
+
 def main():
     """
     Create Elastic Search Domain
@@ -419,47 +1161,43 @@ def main():
     profile = args.profile
     domainname = args.name
     action = args.action.upper()
-    regex_pattern = '^(([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])\.){3}([0-9]|[1-9][0-9]|1[0-9]{2}|2[0-4][0-9]|25[0-5])(\/([0-9]|[1-2][0-9]|3[0-2]))$'
 
-    session = boto3.Session(profile_name=profile)
+    if action not in ['CREATE', 'UPDATE', 'DELETE']:
+        print('Unrecognised action specified, please set either CREATE, UPDATE or DELETE')
+        return
+
+    if args.manifest:
+        targets = load_manifest(args.manifest, action)
+        if action in ['DELETE']:
+            user_input = input('Are you sure you want to delete the ELK stacks {0}? '
+                               .format(', '.join(target_label(target) for target in targets)))
+            if user_input.upper() not in ['YES', 'Y']:
+                print('No action performed. Exiting.')
+                return
+        if run_fleet(action, targets, args.workers, args.timeout * 60, args.kibana):
+            exit(1)
+        return
 
-    sts = session.client('sts')
-    account_id = sts.get_caller_identity()['Account']
+    session = boto3.Session(profile_name=profile)
+    cidr = None
 
     if action in ['CREATE']:
         cidr = input('Please provide a CIDR block to restrict access to elasticsearch domain: {0}\n'.format(domainname))
-        if not re.match(regex_pattern, cidr):
+        if not re.match(CIDR_PATTERN, cidr):
             while True:
                 print('The provided CIDR: \'{0}\' does not match a cidr pattern. eg. 0-255.0-255.0-255.0-255/0-32'.format(cidr))
                 cidr = input('Please provide a working CIDR block\n')
-                if re.match(regex_pattern, cidr):
+                if re.match(CIDR_PATTERN, cidr):
                     break
                 else:
                     continue
-        role_arn = create_lambda_iam_role(domainname, session)
-        endpoint = create_elasticsearch_domain(domainname, account_id, session, role_arn, cidr)
-        create_lambda_functions(domainname, endpoint, session, role_arn)
-        configure_kibana(endpoint)
-        print('Kibana Endpoint: \'https://{0}/_plugin/kibana/\''.format(endpoint))
-        print('elk {0} has been fully created'.format(domainname))
-    elif action in ['UPDATE']:
-        es = session.client('es')
-        es_status = es.describe_elasticsearch_domain(DomainName=domainname)
-        endpoint = es_status['DomainStatus']['Endpoint']
-
-        if args.role == 'NOROLESPECIFIED':
-            raise RuntimeError("Role ARN -r/--role must be specified to update lambdas")
-
-        delete_lambda_functions(domainname, session)
-        create_lambda_functions(domainname, endpoint, session, args.role)
     elif action in ['DELETE']:
         user_input = input('Are you sure you want to delete the ELK stack with name {0}? '.format(domainname))
-        if user_input.upper() in ['YES', 'Y']:
-            delete_elk(domainname, session)
-        else:
+        if user_input.upper() not in ['YES', 'Y']:
             print('No action performed. Exiting.')
-    else:
-        print('Unrecognised action specified, please set either CREATE or DELETE')
+            return
+
+    run_action(action, domainname, session, cidr, args.role, args.timeout * 60, kibana=args.kibana)
 
 if __name__ == '__main__':
     main()
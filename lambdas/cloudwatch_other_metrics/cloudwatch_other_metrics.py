@@ -1,168 +1,1166 @@
 from __future__ import print_function
 import boto3
-import urllib2
+import calendar
 import datetime
+import hashlib
 import json
-from botocore.auth import SigV4Auth
-from botocore.awsrequest import AWSRequest
+import random
+import threading
+import time
+import Queue
+import es_client
+from botocore.exceptions import ClientError
 
+# The maximum number of queries cloudwatch accepts in a single GetMetricData request
+MAX_METRIC_DATA_QUERIES = 500
 
-def get_other_metrics(input_dict):
+# How to find the resources in each namespace and which dimension identifies them in cloudwatch.
+#   service/operation: the boto3 client and call used to list the resources
+#   result_key: the (dotted) path to the list of resources in the response
+#   id_key: the key holding each resource's id, or None if the list holds ids directly
+#   id_separator: if set, only the part of the id after the last separator is used. eg: SQS queue urls
+#   dimension: the cloudwatch dimension the id is matched against
+#   id_field: the field the id is stored in on each elasticsearch document
+#   extra_dimensions: any dimensions with fixed values the namespace also requires
+#   region: the region the namespace's metrics are published in, if not the lambda's own region
+#   units: the unit of each metric, as GetMetricData does not return them. Metrics not listed have the unit 'None'
+# Further namespaces, or overrides of these, can be supplied in the 'namespaces' key of the lambda's input.
+NAMESPACES = {
+    'AWS/RDS': {
+        'service': 'rds',
+        'operation': 'describe_db_instances',
+        'result_key': 'DBInstances',
+        'id_key': 'DBInstanceIdentifier',
+        'dimension': 'DBInstanceIdentifier',
+        'id_field': 'database_id',
+        'units': {
+            'CPUUtilization': 'Percent',
+            'FreeStorageSpace': 'Bytes',
+            'FreeableMemory': 'Bytes',
+            'SwapUsage': 'Bytes',
+            'DatabaseConnections': 'Count',
+            'DiskQueueDepth': 'Count',
+            'ReadIOPS': 'Count/Second',
+            'WriteIOPS': 'Count/Second',
+            'ReadLatency': 'Seconds',
+            'WriteLatency': 'Seconds',
+            'ReadThroughput': 'Bytes/Second',
+            'WriteThroughput': 'Bytes/Second',
+            'NetworkReceiveThroughput': 'Bytes/Second',
+            'NetworkTransmitThroughput': 'Bytes/Second'
+        }
+    },
+    'AWS/EBS': {
+        'service': 'ec2',
+        'operation': 'describe_volumes',
+        'result_key': 'Volumes',
+        'id_key': 'VolumeId',
+        'dimension': 'VolumeId',
+        'id_field': 'volume_id',
+        'units': {
+            'VolumeReadBytes': 'Bytes',
+            'VolumeWriteBytes': 'Bytes',
+            'VolumeReadOps': 'Count',
+            'VolumeWriteOps': 'Count',
+            'VolumeTotalReadTime': 'Seconds',
+            'VolumeTotalWriteTime': 'Seconds',
+            'VolumeIdleTime': 'Seconds',
+            'VolumeQueueLength': 'Count',
+            'BurstBalance': 'Percent'
+        }
+    },
+    'AWS/CloudFront': {
+        'service': 'cloudfront',
+        'operation': 'list_distributions',
+        'result_key': 'DistributionList.Items',
+        'id_key': 'Id',
+        'dimension': 'DistributionId',
+        'id_field': 'distribution_id',
+        'extra_dimensions': [{'Name': 'Region', 'Value': 'Global'}],
+        'region': 'us-east-1',
+        'units': {
+            'Requests': 'None',
+            'BytesDownloaded': 'None',
+            'BytesUploaded': 'None',
+            'TotalErrorRate': 'Percent',
+            '4xxErrorRate': 'Percent',
+            '5xxErrorRate': 'Percent'
+        }
+    },
+    'AWS/ELB': {
+        'service': 'elb',
+        'operation': 'describe_load_balancers',
+        'result_key': 'LoadBalancerDescriptions',
+        'id_key': 'LoadBalancerName',
+        'dimension': 'LoadBalancerName',
+        'id_field': 'load_balancer',
+        'units': {
+            'RequestCount': 'Count',
+            'Latency': 'Seconds',
+            'HealthyHostCount': 'Count',
+            'UnHealthyHostCount': 'Count',
+            'BackendConnectionErrors': 'Count',
+            'SurgeQueueLength': 'Count',
+            'SpilloverCount': 'Count',
+            'HTTPCode_Backend_2XX': 'Count',
+            'HTTPCode_Backend_3XX': 'Count',
+            'HTTPCode_Backend_4XX': 'Count',
+            'HTTPCode_Backend_5XX': 'Count',
+            'HTTPCode_ELB_4XX': 'Count',
+            'HTTPCode_ELB_5XX': 'Count'
+        }
+    },
+    'AWS/DynamoDB': {
+        'service': 'dynamodb',
+        'operation': 'list_tables',
+        'result_key': 'TableNames',
+        'id_key': None,
+        'dimension': 'TableName',
+        'id_field': 'table_name',
+        'units': {
+            'ConsumedReadCapacityUnits': 'Count',
+            'ConsumedWriteCapacityUnits': 'Count',
+            'ProvisionedReadCapacityUnits': 'Count',
+            'ProvisionedWriteCapacityUnits': 'Count',
+            'ReadThrottleEvents': 'Count',
+            'WriteThrottleEvents': 'Count',
+            'ThrottledRequests': 'Count',
+            'SuccessfulRequestLatency': 'Milliseconds',
+            'UserErrors': 'Count',
+            'SystemErrors': 'Count'
+        }
+    },
+    'AWS/Lambda': {
+        'service': 'lambda',
+        'operation': 'list_functions',
+        'result_key': 'Functions',
+        'id_key': 'FunctionName',
+        'dimension': 'FunctionName',
+        'id_field': 'function_name',
+        'units': {
+            'Invocations': 'Count',
+            'Errors': 'Count',
+            'Throttles': 'Count',
+            'Duration': 'Milliseconds',
+            'ConcurrentExecutions': 'Count',
+            'IteratorAge': 'Milliseconds',
+            'DeadLetterErrors': 'Count'
+        }
+    },
+    'AWS/SQS': {
+        'service': 'sqs',
+        'operation': 'list_queues',
+        'result_key': 'QueueUrls',
+        'id_key': None,
+        'id_separator': '/',
+        'dimension': 'QueueName',
+        'id_field': 'queue_name',
+        'units': {
+            'ApproximateNumberOfMessagesVisible': 'Count',
+            'ApproximateNumberOfMessagesNotVisible': 'Count',
+            'ApproximateNumberOfMessagesDelayed': 'Count',
+            'ApproximateAgeOfOldestMessage': 'Seconds',
+            'NumberOfMessagesSent': 'Count',
+            'NumberOfMessagesReceived': 'Count',
+            'NumberOfMessagesDeleted': 'Count',
+            'NumberOfEmptyReceives': 'Count',
+            'SentMessageSize': 'Bytes'
+        }
+    }
+}
+
+# Error codes returned by AWS when a request has been throttled
+THROTTLING_ERROR_CODES = ['Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException']
+
+# The delay, in seconds, shared by all workers before each AWS call. It doubles whenever a call is throttled
+# and halves whenever a call succeeds, so every worker slows down together while cloudwatch is pushing back.
+throttle_state = {'delay': 0.0}
+throttle_lock = threading.Lock()
+
+# The default limits on the size of each _bulk request. The payload limit of the smallest elasticsearch
+# instance types is 10MB, so chunks are kept well below it.
+DEFAULT_BULK_MAX_BYTES = 5 * 1024 * 1024
+DEFAULT_BULK_MAX_DOCUMENTS = 1000
+
+# The number of times documents rejected by elasticsearch because it is too busy are sent again
+DEFAULT_BULK_RETRIES = 3
+
+# The delay, in seconds, before rejected documents are first sent again. It doubles with every retry.
+BULK_RETRY_BASE_DELAY = 0.25
+
+# The number of seconds after sending starts that rejected documents can still be sent again.
+# Documents still rejected after that are counted as failed, so the lambda finishes within its timeout.
+DEFAULT_BULK_RETRY_SECONDS = 5
+
+# Retries also stop this many seconds before the lambda would time out, leaving time to save the watermarks
+LAMBDA_TIMEOUT_MARGIN_SECONDS = 2
+
+# The number of seconds a namespace's list of resources is reused for before it is listed again
+DEFAULT_INVENTORY_TTL = 900
+
+# Resources discovered per namespace, kept for as long as the lambda container is reused.
+# Each entry is a dict of the time the resources were listed and the list of resource ids.
+inventory_cache = {}
+inventory_lock = threading.Lock()
+
+# The default granularity, in seconds, of collected datapoints
+DEFAULT_PERIOD = 300
+
+# The number of minutes of datapoints requested when only the latest datapoint is wanted
+DEFAULT_WINDOW_MINUTES = 20
+
+# In incremental mode, how far back, in minutes, datapoints missed by failed runs are fetched again
+DEFAULT_BACKFILL_MINUTES = 180
+
+# In incremental mode, the timestamp (in seconds since the epoch) of the newest datapoint indexed for each
+# namespace, resource and metric. Kept for as long as the lambda container is reused, and in S3 if a
+# 'watermark_bucket' is provided.
+watermarks = {}
+watermark_lock = threading.Lock()
+
+# boto3 clients are thread safe, but creating them from the default session is not
+clients = {}
+client_lock = threading.Lock()
+
+# Assumed role credentials are refreshed once they are this many seconds from expiring
+CREDENTIAL_REFRESH_SECONDS = 300
+
+# For each role assumed to collect from another account, a dict of the session created from the role's
+# credentials, when those credentials expire, and the clients created from the session.
+# Each role has its own lock, so every account's role is assumed at the same time. role_session_lock only guards
+# creating those locks.
+role_sessions = {}
+role_session_locks = {}
+role_session_lock = threading.Lock()
+
+
+def get_other_metrics(input_dict, context=None):
     """
 
     :param input_dict:
+    :param context: The lambda context, used to stop retrying rejected documents before the lambda times out
     :return:
     """
 
     metricgroups = input_dict['metrics']
-    pulled_data = []
+    workers = int(input_dict.get('workers', 1))
+    namespaces = get_namespaces(input_dict)
 
-    for namespace in metricgroups.keys():
-        metrics = metricgroups[namespace]
-        pulled_data.append(get_metrics(namespace, metrics, input_dict))
+    for namespace in sorted(metricgroups.keys()):
+        if namespace not in namespaces:
+            print('No resource discovery is configured for namespace {0}, skipping it'.format(namespace))
+    metricgroups = dict((namespace, metrics) for namespace, metrics in metricgroups.items() if namespace in namespaces)
 
-    transformed_data = transform_data(pulled_data)
-    make_request(input_dict['endpoint'], transformed_data, method='POST')
+    # Every account is collected at the same time as every other. Without 'role_arns', only the lambda's own is.
+    role_arns = input_dict.get('role_arns') or [None]
 
+    # Namespaces are sorted so the order of the bulk payload doesn't depend on which worker finishes first
+    items = [(role_arn, namespace) for role_arn in role_arns for namespace in sorted(metricgroups.keys())]
 
-def get_metrics(namespace, metrics, input_dict):
-    """
+    # Namespaces and accounts are collected by up to 'workers' threads, and each of those runs its GetMetricData
+    # batches on its share of 'workers', so no more than 'workers' GetMetricData calls are ever made at once
+    batch_workers = max(1, workers // max(1, min(workers, len(items))))
 
-    :param namespace:
-    :param metrics:
-    :param input_dict:
-    :return:
+    def collect(item):
+        role_arn, namespace = item
+        try:
+            return get_metrics(namespace, metricgroups[namespace], input_dict, role_arn, batch_workers)
+        except Exception as e:
+            # One namespace or account failing, eg. because a role is missing a permission or can't be assumed,
+            # doesn't stop the others being collected
+            print('Could not collect {0} metrics from {1}. Error was: {2}'
+                  .format(namespace, 'account {0}'.format(role_account(role_arn)) if role_arn else 'this account', e))
+            return {}
+
+    pulled_data = run_concurrently(collect, items, workers)
+    pulled_namespaces = [namespace for _, namespace in items]
+
+    wide = input_dict.get('layout') == 'wide'
+    if wide:
+        lines = generate_wide_bulk_lines(pulled_data, pulled_namespaces,
+                                         document_ids=bool(input_dict.get('document_ids')))
+    else:
+        lines = generate_bulk_lines(pulled_data, pulled_namespaces if input_dict.get('document_ids') else None)
+
+    retry_deadline = time.time() + float(input_dict.get('bulk_retry_seconds', DEFAULT_BULK_RETRY_SECONDS))
+    if context is not None:
+        retry_deadline = min(retry_deadline, time.time() + context.get_remaining_time_in_millis() / 1000.0
+                             - LAMBDA_TIMEOUT_MARGIN_SECONDS)
+
+    summary = send_bulk(input_dict['endpoint'], lines,
+                        max_bytes=int(input_dict.get('bulk_max_bytes', DEFAULT_BULK_MAX_BYTES)),
+                        max_documents=int(input_dict.get('bulk_max_documents', DEFAULT_BULK_MAX_DOCUMENTS)),
+                        max_retries=int(input_dict.get('bulk_retries', DEFAULT_BULK_RETRIES)),
+                        compress=bool(input_dict.get('compress', False)),
+                        retry_deadline=retry_deadline)
+    print('Indexed {0} documents, {1} failed'.format(summary['indexed'], summary['failed']))
+
+    # Documents elasticsearch was too busy to index hold their metrics' watermarks back, so the next run backfills them
+    if input_dict.get('incremental'):
+        update_watermarks(document_datapoints(pulled_data, pulled_namespaces, wide), summary['retryable'], input_dict)
+
+
+def get_metrics(namespace, metrics, input_dict, role_arn=None, workers=None):
+    """
+    Collects the latest datapoint of each metric for every resource in the namespace.
+    Queries are packed into as few GetMetricData calls as possible rather than issuing
+    one GetMetricStatistics call per resource and metric.
+    'measurement' may be a list of statistics, including percentiles such as 'p99', and 'periods' a list of
+    periods in seconds. Every statistic of a datapoint is returned on the same metric value, and each period
+    is returned as a separate value.
+    If 'incremental' is set in the input, every complete datapoint newer than the metric's watermark is
+    collected instead, going back at most 'backfill_minutes', and each one carries its own timestamp.
+    Datapoints also carry their own timestamp if 'document_ids' is set, so their document ids are stable.
+    If a role is provided, metrics are pulled from the role's account and each value carries that 'account'.
+    :param namespace: The cloudwatch namespace to pull metrics from. eg: 'AWS/RDS'
+    :param metrics: A list of metric names to pull for each resource in the namespace
+    :param input_dict: The event passed to the lambda function
+    :param role_arn: The ARN of a role to assume to pull metrics from another account
+    :param workers: The number of GetMetricData batches to run at the same time. Defaults to 'workers' in the input
+    :return: A dict of resource id to a list of metric values for that resource
     """
-    cw_client = boto3.client('cloudwatch')
     responses = {}
+    if workers is None:
+        workers = int(input_dict.get('workers', 1))
+
+    config = get_namespaces(input_dict).get(namespace)
+    if not config:
+        return responses
+
+    cw_client = get_client('cloudwatch', config.get('region'), role_arn)
+    account = role_account(role_arn)
 
     end = datetime.datetime.utcnow()
-    start = end - datetime.timedelta(minutes=20)
-    period = 300
-
-    if namespace == 'AWS/RDS':
-        db_client = boto3.client('rds')
-        for db in db_client.describe_db_instances()['DBInstances']:
-            dimensions = [{"Name": "DBInstanceIdentifier",
-                           "Value": db['DBInstanceIdentifier']}]
-            for metric in metrics:
-                info = cw_client.get_metric_statistics(
-                    Namespace=namespace,
-                    MetricName=metric,
-                    StartTime=start,
-                    EndTime=end,
-                    Period=period,
-                    Statistics=[input_dict['measurement']],
-                    Dimensions=dimensions
-                )
-                if info['Datapoints']:
-                    responses.setdefault(db['DBInstanceIdentifier'], []).append({
-                        'metric': metric,
-                        'value': info['Datapoints'][-1][input_dict['measurement']],
-                        'unit': info['Datapoints'][-1]['Unit'],
-                        'database_id': db['DBInstanceIdentifier']
-                    })
+    end_epoch = calendar.timegm(end.utctimetuple())
+    statistics = get_statistics(input_dict)
+    periods = get_periods(input_dict)
+    incremental = input_dict.get('incremental')
 
-    if namespace == 'AWS/EBS':
-        ebs_client = boto3.client('ec2')
-        for vol in ebs_client.describe_volumes()['Volumes']:
-            dimensions = [{"Name": "VolumeId",
-                           "Value": vol['VolumeId']
-                           }]
-            for metric in metrics:
-                info = cw_client.get_metric_statistics(
-                    Namespace=namespace,
-                    MetricName=metric,
-                    StartTime=start,
-                    EndTime=end,
-                    Period=period,
-                    Statistics=[input_dict['measurement']],
-                    Dimensions=dimensions
-                )
-                if info['Datapoints']:
-                    responses.setdefault(vol['VolumeId'], []).append({
-                        'metric': metric,
-                        'value': info['Datapoints'][-1][input_dict['measurement']],
-                        'unit': info['Datapoints'][-1]['Unit'],
-                        'volume_id': vol['VolumeId']
-                    })
+    id_field = config['id_field']
+    resource_ids = get_resources(namespace, config, input_dict, role_arn)
+
+    if not resource_ids:
+        return responses
+
+    queries, lookup = build_metric_queries(namespace, metrics, config['dimension'], resource_ids,
+                                           statistics, periods, config.get('extra_dimensions', []))
+
+    known = get_watermarks(input_dict) if incremental else {}
+    horizon = end - datetime.timedelta(minutes=int(input_dict.get('backfill_minutes', DEFAULT_BACKFILL_MINUTES)))
+
+    # GetMetricData takes one time window per call, so queries are grouped by where their window starts
+    queries_by_start = {}
+    for query in queries:
+        resource_id, metric, statistic, period = lookup[query['Id']]
+        start = end - max(datetime.timedelta(minutes=DEFAULT_WINDOW_MINUTES), datetime.timedelta(seconds=2 * period))
+        watermark = known.get(watermark_key(namespace, resource_id, metric, period, account))
+        if watermark:
+            start = max(datetime.datetime.utcfromtimestamp(watermark), horizon)
+        queries_by_start.setdefault(start, []).append(query)
+
+    results = {}
+    for start in sorted(queries_by_start):
+        results.update(get_metric_data(cw_client, queries_by_start[start], start, end, workers=workers))
+
+    # The values of every statistic, by timestamp, for each resource, metric and period
+    series = {}
+    for query in queries:
+        resource_id, metric, statistic, period = lookup[query['Id']]
+        datapoints = series.setdefault((resource_id, metric, period), {})
+        for timestamp, value in results.get(query['Id'], []):
+            datapoints.setdefault(timestamp, {})[statistic] = value
+
+    for query in queries:
+        resource_id, metric, statistic, period = lookup[query['Id']]
+        datapoints = series[(resource_id, metric, period)]
+        if statistic != statistics[0] or not datapoints:
+            continue
+
+        if incremental:
+            watermark = known.get(watermark_key(namespace, resource_id, metric, period, account), 0)
+            # The newest period may still be receiving data, so it's left for the next run
+            timestamps = [timestamp for timestamp in sorted(datapoints)
+                          if watermark < calendar.timegm(timestamp.utctimetuple()) <= end_epoch - period]
+        else:
+            timestamps = [max(datapoints)]
+
+        for timestamp in timestamps:
+            values = datapoints[timestamp]
+            if statistics[0] not in values:
+                continue
+
+            data_dict = {
+                'metric': metric,
+                'value': values[statistics[0]],
+                'unit': config.get('units', {}).get(metric, 'None'),
+                id_field: resource_id
+            }
+            if account:
+                data_dict['account'] = account
+            if len(statistics) > 1:
+                data_dict['statistics'] = dict((stat, values[stat]) for stat in statistics[1:] if stat in values)
+            if len(periods) > 1:
+                data_dict['period'] = period
+            if incremental or input_dict.get('document_ids'):
+                data_dict['timestamp'] = timestamp
+            responses.setdefault(resource_id, []).append(data_dict)
 
     return responses
 
 
+def get_statistics(input_dict):
+    """
+    :param input_dict: The event passed to the lambda function
+    :return: The list of statistics to collect. The first one is stored in the metric's own field.
+    """
+
+    statistics = input_dict['measurement']
+    return [statistics] if isinstance(statistics, basestring) else list(statistics)
+
+
+def get_periods(input_dict):
+    """
+    :param input_dict: The event passed to the lambda function
+    :return: The list of periods, in seconds, to collect datapoints at
+    """
+
+    return [int(period) for period in input_dict.get('periods', [DEFAULT_PERIOD])]
+
+
+def watermark_key(namespace, resource_id, metric, period, account=None):
+    """
+    :param account: The account the metric was pulled from, if it isn't the lambda's own
+    :return: The key a metric's watermark is stored under
+    """
+
+    key = '{0}|{1}|{2}|{3}'.format(namespace, resource_id, metric, period)
+    return '{0}|{1}'.format(account, key) if account else key
+
+
+def get_watermarks(input_dict):
+    """
+    Returns the watermarks of every metric, loading them from the 'watermark_bucket' S3 bucket on a cold start.
+    :param input_dict: The event passed to the lambda function
+    :return: A dict of watermark key to the timestamp of the newest datapoint indexed for that metric
+    """
+
+    with watermark_lock:
+        if not watermarks and input_dict.get('watermark_bucket'):
+            try:
+                snapshot = get_client('s3').get_object(Bucket=input_dict['watermark_bucket'],
+                                                       Key=input_dict.get('watermark_key', 'watermarks.json'))
+                watermarks.update(json.loads(snapshot['Body'].read()))
+            except Exception as e:
+                if 'NoSuchKey' not in str(e):
+                    print('Could not load the saved watermarks. Error was: {0}'.format(e))
+        return dict(watermarks)
+
+
+def update_watermarks(documents, retryable, input_dict):
+    """
+    Moves each metric's watermark up to the newest datapoint that has been indexed for it,
+    and saves the watermarks to the 'watermark_bucket' S3 bucket if one is configured.
+    A metric with a document that elasticsearch was too busy to index only moves up to the newest datapoint before
+    that document, so the next run fetches it again. Documents that failed for any other reason, eg. a mapping error,
+    would only fail again, so they don't hold watermarks back.
+    :param documents: The metric values held by each document that was sent, as returned by document_datapoints
+    :param retryable: The positions in documents of those that weren't indexed because elasticsearch was too busy
+    :param input_dict: The event passed to the lambda function
+    """
+
+    default_period = get_periods(input_dict)[0]
+
+    def datapoint(namespace, resource_id, data_dict):
+        key = watermark_key(namespace, resource_id, data_dict['metric'], data_dict.get('period', default_period),
+                            data_dict.get('account'))
+        return key, calendar.timegm(data_dict['timestamp'].utctimetuple())
+
+    held_back = {}
+    for position in retryable:
+        for namespace, resource_id, data_dict in documents[position]:
+            key, epoch = datapoint(namespace, resource_id, data_dict)
+            held_back[key] = min(held_back.get(key, epoch), epoch)
+
+    with watermark_lock:
+        for document in documents:
+            for namespace, resource_id, data_dict in document:
+                key, epoch = datapoint(namespace, resource_id, data_dict)
+                if key not in held_back or epoch < held_back[key]:
+                    watermarks[key] = max(watermarks.get(key, 0), epoch)
+        snapshot = json.dumps(watermarks)
+
+    if input_dict.get('watermark_bucket'):
+        try:
+            get_client('s3').put_object(Bucket=input_dict['watermark_bucket'],
+                                        Key=input_dict.get('watermark_key', 'watermarks.json'),
+                                        Body=snapshot)
+        except Exception as e:
+            print('Could not save the watermarks. Error was: {0}'.format(e))
+
+
+def get_namespaces(input_dict):
+    """
+    Returns the namespace registry, with any namespaces from the lambda's input added to or overriding the defaults.
+    :param input_dict: The event passed to the lambda function
+    :return: A dict of namespace to its discovery and dimension configuration
+    """
+
+    namespaces = dict(NAMESPACES)
+
+    for namespace, config in input_dict.get('namespaces', {}).items():
+        # Entries for known namespaces only need the keys they change, eg. just 'units'
+        merged = dict(namespaces.get(namespace, {}))
+        merged.update(config)
+        merged['units'] = dict(namespaces.get(namespace, {}).get('units', {}))
+        merged['units'].update(config.get('units', {}))
+        namespaces[namespace] = merged
+
+    return namespaces
+
+
+def get_resources(namespace, config, input_dict, role_arn=None):
+    """
+    Returns the ids of every resource in a namespace, only listing them again once the cached inventory is older
+    than the 'inventory_ttl' (in seconds) of the lambda's input. If an 'inventory_bucket' is provided the inventory
+    is also saved to S3, so a cold start can reuse it and a failed listing can fall back to it.
+    :param namespace: The cloudwatch namespace. eg: 'AWS/EBS'
+    :param config: The registry entry for the namespace
+    :param input_dict: The event passed to the lambda function
+    :param role_arn: The ARN of a role to assume to list the resources of another account
+    :return: A list of resource ids, as they appear in the namespace's cloudwatch dimension
+    """
+
+    account = role_account(role_arn)
+    cache_key = (account, namespace)
+    ttl = int(input_dict.get('inventory_ttl', DEFAULT_INVENTORY_TTL))
+    now = time.time()
+
+    cached = inventory_cache.get(cache_key)
+    if cached is None:
+        cached = load_inventory_snapshot(namespace, input_dict, account)
+        if cached is not None:
+            with inventory_lock:
+                inventory_cache[cache_key] = cached
+
+    if cached is not None and now - cached['time'] < ttl:
+        return cached['resources']
+
+    try:
+        resource_ids = discover_resources(config, role_arn)
+    except Exception as e:
+        if cached is None:
+            raise
+        print('Could not list the resources for {0}, reusing the inventory from {1} seconds ago. Error was: {2}'
+              .format(namespace, int(now - cached['time']), e))
+        return cached['resources']
+
+    inventory = {'time': now, 'resources': resource_ids}
+    with inventory_lock:
+        inventory_cache[cache_key] = inventory
+
+    if cached is None or cached['resources'] != resource_ids:
+        save_inventory_snapshot(namespace, inventory, input_dict, account)
+
+    return resource_ids
+
+
+def load_inventory_snapshot(namespace, input_dict, account=None):
+    """
+    Loads the last saved inventory of a namespace from the 'inventory_bucket' S3 bucket, if one is configured.
+    :param namespace: The cloudwatch namespace. eg: 'AWS/EBS'
+    :param input_dict: The event passed to the lambda function
+    :param account: The account the inventory belongs to, if it isn't the lambda's own
+    :return: The saved inventory, or None if there isn't one
+    """
+
+    if not input_dict.get('inventory_bucket'):
+        return None
+
+    try:
+        snapshot = get_client('s3').get_object(Bucket=input_dict['inventory_bucket'],
+                                               Key=inventory_snapshot_key(namespace, input_dict, account))
+        return json.loads(snapshot['Body'].read())
+    except Exception as e:
+        if 'NoSuchKey' not in str(e):
+            print('Could not load the saved inventory for {0}. Error was: {1}'.format(namespace, e))
+        return None
+
+
+def save_inventory_snapshot(namespace, inventory, input_dict, account=None):
+    """
+    Saves the inventory of a namespace to the 'inventory_bucket' S3 bucket, if one is configured.
+    :param namespace: The cloudwatch namespace. eg: 'AWS/EBS'
+    :param inventory: A dict of the time the resources were listed and the list of resource ids
+    :param input_dict: The event passed to the lambda function
+    :param account: The account the inventory belongs to, if it isn't the lambda's own
+    """
+
+    if not input_dict.get('inventory_bucket'):
+        return
+
+    try:
+        get_client('s3').put_object(Bucket=input_dict['inventory_bucket'],
+                                    Key=inventory_snapshot_key(namespace, input_dict, account),
+                                    Body=json.dumps(inventory))
+    except Exception as e:
+        print('Could not save the inventory for {0}. Error was: {1}'.format(namespace, e))
+
+
+def inventory_snapshot_key(namespace, input_dict, account=None):
+    """
+    :param namespace: The cloudwatch namespace. eg: 'AWS/EBS'
+    :param input_dict: The event passed to the lambda function
+    :param account: The account the inventory belongs to, if it isn't the lambda's own
+    :return: The S3 key the namespace's inventory is saved under
+    """
+
+    prefix = input_dict.get('inventory_prefix', 'inventory/')
+    if account:
+        prefix = '{0}{1}/'.format(prefix, account)
+    return '{0}{1}.json'.format(prefix, namespace.replace('/', '_'))
+
+
+def discover_resources(config, role_arn=None):
+    """
+    Lists the ids of every resource in a namespace using the namespace's registry entry,
+    following every page of results when the call supports pagination.
+    :param config: The registry entry for the namespace
+    :param role_arn: The ARN of a role to assume to list the resources of another account
+    :return: A list of resource ids, as they appear in the namespace's cloudwatch dimension
+    """
+
+    client = get_client(config['service'], config.get('region'), role_arn)
+
+    if client.can_paginate(config['operation']):
+        pages = client.get_paginator(config['operation']).paginate()
+    else:
+        pages = [getattr(client, config['operation'])()]
+
+    items = []
+    for page in pages:
+        page_items = page
+        for key in config['result_key'].split('.'):
+            page_items = page_items.get(key, [])
+        items.extend(page_items)
+
+    resource_ids = []
+    for item in items:
+        resource_id = item[config['id_key']] if config.get('id_key') else item
+        if config.get('id_separator'):
+            resource_id = resource_id.rsplit(config['id_separator'], 1)[-1]
+        resource_ids.append(resource_id)
+
+    return resource_ids
+
+
+def build_metric_queries(namespace, metrics, dimension_name, resource_ids, statistics, periods,
+                         extra_dimensions=()):
+    """
+    Builds a GetMetricData query for every combination of resource, metric, period and statistic.
+    :param namespace: The cloudwatch namespace the metrics belong to
+    :param metrics: A list of metric names
+    :param dimension_name: The name of the dimension that identifies a resource. eg: 'VolumeId'
+    :param resource_ids: A list of resource ids to use as the dimension value
+    :param statistics: A list of statistics to request. eg: ['Average', 'Maximum', 'p99']
+    :param periods: A list of granularities, in seconds, of the returned datapoints
+    :param extra_dimensions: Any dimensions with fixed values to add to every query
+    :return: A list of queries, and a dict of query id to a (resource id, metric, statistic, period) tuple
+    """
+
+    queries = []
+    lookup = {}
+
+    for resource_id in resource_ids:
+        for metric in metrics:
+            for period in periods:
+                for statistic in statistics:
+                    # Ids must start with a lowercase letter and be unique within a request
+                    query_id = 'm{0}'.format(len(queries))
+                    lookup[query_id] = (resource_id, metric, statistic, period)
+                    queries.append({
+                        'Id': query_id,
+                        'MetricStat': {
+                            'Metric': {
+                                'Namespace': namespace,
+                                'MetricName': metric,
+                                'Dimensions': [{'Name': dimension_name, 'Value': resource_id}] + list(extra_dimensions)
+                            },
+                            'Period': period,
+                            'Stat': statistic
+                        },
+                        'ReturnData': True
+                    })
+
+    return queries, lookup
+
+
+def get_metric_data(cw_client, queries, start, end, workers=1):
+    """
+    Runs the provided queries through GetMetricData, packing up to MAX_METRIC_DATA_QUERIES
+    queries into each call and following NextToken until every result has been returned.
+    :param cw_client: A boto3 cloudwatch client
+    :param queries: A list of queries as built by build_metric_queries
+    :param start: The start of the time window to query
+    :param end: The end of the time window to query
+    :param workers: The number of GetMetricData batches to run at the same time
+    :return: A dict of query id to a list of (timestamp, value) tuples
+    """
+
+    def fetch_batch(batch):
+        batch_results = []
+        kwargs = {
+            'MetricDataQueries': batch,
+            'StartTime': start,
+            'EndTime': end,
+            'ScanBy': 'TimestampDescending'
+        }
+
+        while True:
+            response = call_with_backoff(cw_client.get_metric_data, **kwargs)
+            batch_results.extend(response['MetricDataResults'])
+
+            if not response.get('NextToken'):
+                break
+            kwargs['NextToken'] = response['NextToken']
+
+        return batch_results
+
+    batches = [queries[offset:offset + MAX_METRIC_DATA_QUERIES]
+               for offset in range(0, len(queries), MAX_METRIC_DATA_QUERIES)]
+
+    results = {}
+    for batch_results in run_concurrently(fetch_batch, batches, workers):
+        for result in batch_results:
+            results.setdefault(result['Id'], []).extend(zip(result['Timestamps'], result['Values']))
+
+    return results
+
+
+def run_concurrently(func, items, workers):
+    """
+    Calls func on every item using a bounded pool of threads.
+    :param func: The function to call with each item
+    :param items: A list of items to process
+    :param workers: The maximum number of threads to run at once. 1 or less runs everything in the calling thread
+    :return: A list of the results of func, in the same order as items
+    """
+
+    if workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    work = Queue.Queue()
+
+    for position, item in enumerate(items):
+        work.put((position, item))
+
+    def worker():
+        while True:
+            try:
+                position, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[position] = func(item)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+def call_with_backoff(func, max_attempts=8, **kwargs):
+    """
+    Calls an AWS api function, backing off and retrying whenever the call is throttled.
+    The backoff delay is shared between threads so all workers slow down together.
+    :param func: The boto3 client method to call
+    :param max_attempts: The number of times to try the call before giving up
+    :param kwargs: The arguments to pass to func
+    :return: The response of the call
+    """
+
+    for attempt in range(1, max_attempts + 1):
+        delay = throttle_state['delay']
+        if delay:
+            time.sleep(random.uniform(delay / 2, delay))
+
+        try:
+            response = func(**kwargs)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in THROTTLING_ERROR_CODES or attempt == max_attempts:
+                raise
+            with throttle_lock:
+                throttle_state['delay'] = min(max(throttle_state['delay'] * 2, 0.2), 10.0)
+            print('Request was throttled, backing off for up to {0:.1f} seconds'.format(throttle_state['delay']))
+            continue
+
+        with throttle_lock:
+            throttle_state['delay'] = throttle_state['delay'] / 2 if throttle_state['delay'] > 0.2 else 0.0
+        return response
+
+
+def get_client(service, region=None, role_arn=None):
+    """
+    Returns a boto3 client for the service, creating it only once per lambda container.
+    :param service: The name of the AWS service. eg: 'cloudwatch'
+    :param region: The region to connect to. Defaults to the lambda's own region
+    :param role_arn: The ARN of a role to assume to connect to another account. The client is created again
+    whenever the role's credentials are refreshed
+    :return: A boto3 client
+    """
+
+    if role_arn:
+        role_session = get_role_session(role_arn)
+        with client_lock:
+            if (service, region) not in role_session['clients']:
+                role_session['clients'][(service, region)] = role_session['session'].client(service, region_name=region)
+            return role_session['clients'][(service, region)]
+
+    with client_lock:
+        if (service, region) not in clients:
+            if region:
+                clients[(service, region)] = boto3.client(service, region_name=region)
+            else:
+                clients[(service, region)] = boto3.client(service)
+        return clients[(service, region)]
+
+
+def get_role_session(role_arn):
+    """
+    Returns a boto3 session using a role's credentials, assuming the role only once until the credentials are
+    close to expiring.
+    :param role_arn: The ARN of the role to assume
+    :return: A dict of the 'session', when its credentials expire and the 'clients' created from it
+    """
+
+    with role_session_lock:
+        lock = role_session_locks.setdefault(role_arn, threading.Lock())
+
+    with lock:
+        role_session = role_sessions.get(role_arn)
+        if role_session is None or role_session['expiration'] - time.time() < CREDENTIAL_REFRESH_SECONDS:
+            credentials = call_with_backoff(get_client('sts').assume_role, RoleArn=role_arn,
+                                            RoleSessionName='cloudwatch_other_metrics')['Credentials']
+            role_session = {
+                'session': boto3.session.Session(aws_access_key_id=credentials['AccessKeyId'],
+                                                 aws_secret_access_key=credentials['SecretAccessKey'],
+                                                 aws_session_token=credentials['SessionToken']),
+                'expiration': calendar.timegm(credentials['Expiration'].utctimetuple()),
+                'clients': {}
+            }
+            role_sessions[role_arn] = role_session
+        return role_session
+
+
+def role_account(role_arn):
+    """
+    :param role_arn: The ARN of a role. eg: 'arn:aws:iam::123456789012:role/metrics'
+    :return: The id of the account the role belongs to, or None if there is no role
+    """
+
+    return role_arn.split(':')[4] if role_arn else None
+
+
 def transform_data(data):
     """
+    Builds the body of an elasticsearch _bulk request from the pulled metrics.
+    :param data: A list of dicts of resource id to a list of metric values, as returned by get_metrics
+    :return: The newline delimited _bulk request body
+    """
 
-    :param data:
-    :return:
+    return ''.join(generate_bulk_lines(data))
+
+
+def generate_bulk_lines(data, namespaces=None):
+    """
+    Yields the lines of an elasticsearch _bulk request for the pulled metrics, an index action line followed by
+    a document line for every metric value. The lines can be joined into one body or sent in chunks.
+    :param data: A list of dicts of resource id to a list of metric values, as returned by get_metrics
+    :param namespaces: The namespace each dict in data was pulled from. If provided, every document is given an
+    id derived from its namespace, resource, metric and timestamp, so indexing the same datapoint again
+    overwrites the existing document instead of adding a duplicate
+    :return: A generator of newline terminated json strings
     """
 
     now = datetime.datetime.utcnow()
-    iso_now = now.strftime('%Y-%m-%dT%H:%M:%S.{0}Z'.format(
-        int(round(now.microsecond/1000.0))))
+    iso_now = format_timestamp(now)
     index_name = now.strftime('cw-%Y.%m.%d')
-    return_data = ''
 
-    action = {'index': {}}
-    action['index']['_index'] = index_name
+    # The action line only changes with the index and metric, so each one is only serialised once
+    action_lines = {}
 
+    # One source dict is reused for every document. Its key order, and so the serialised output,
+    # depends on the keys that have been added and removed before, which a fresh dict wouldn't reproduce.
     source = {}
     source['timestamp'] = iso_now
 
-    for object in data:
+    for position, object in enumerate(data):
         for key in object:
             for data_dict in object[key]:
-                action['index']['_type'] = data_dict['metric']
-                return_data += '{0}\n'.format(json.dumps(action))
+                metric = data_dict['metric']
 
-                if 'volume_id' in data_dict:
-                    source['volume_id'] = data_dict['volume_id']
-                elif 'database_id' in data_dict:
-                    source['database_id'] = data_dict['database_id']
+                # Datapoints collected incrementally carry their own timestamp, and go into that day's index
+                document_index = index_name
+                if 'timestamp' in data_dict:
+                    document_index = data_dict['timestamp'].strftime('cw-%Y.%m.%d')
+                    source['timestamp'] = format_timestamp(data_dict['timestamp'])
 
-                source[data_dict['metric']] = data_dict['value']
+                if namespaces is not None:
+                    action = {'index': {}}
+                    action['index']['_index'] = document_index
+                    action['index']['_type'] = metric
+                    action['index']['_id'] = document_id(namespaces[position], key, metric, data_dict.get('period'),
+                                                         data_dict['timestamp'], data_dict.get('account'))
+                    yield '{0}\n'.format(json.dumps(action))
+                else:
+                    if (document_index, metric) not in action_lines:
+                        action = {'index': {}}
+                        action['index']['_index'] = document_index
+                        action['index']['_type'] = metric
+                        action_lines[(document_index, metric)] = '{0}\n'.format(json.dumps(action))
+                    yield action_lines[(document_index, metric)]
+
+                id_fields = [field for field in data_dict
+                             if field not in ('metric', 'value', 'unit', 'timestamp', 'statistics')]
+                # Additional statistics are stored alongside the metric. eg: 'CPUUtilization_p99'
+                for statistic in data_dict.get('statistics', {}):
+                    id_fields.append('{0}_{1}'.format(metric, statistic.replace('.', '_')))
+                    source[id_fields[-1]] = data_dict['statistics'][statistic]
+                for field in id_fields:
+                    if field in data_dict:
+                        source[field] = data_dict[field]
+
+                source[metric] = data_dict['value']
                 source['unit'] = data_dict['unit']
-                return_data += '{0}\n'.format(json.dumps(source))
+                yield '{0}\n'.format(json.dumps(source))
+
+                del source[metric]
+                for field in id_fields:
+                    del source[field]
+                source['timestamp'] = iso_now
+
+
+def generate_wide_bulk_lines(data, namespaces, document_ids=False):
+    """
+    Yields the lines of an elasticsearch _bulk request with one document per resource and timestamp, holding
+    every metric of that resource as its own field alongside a '<metric>_unit' field.
+    eg: {"timestamp": ..., "database_id": "db1", "CPUUtilization": 2.5, "CPUUtilization_unit": "Percent", ...}
+    :param data: A list of dicts of resource id to a list of metric values, as returned by get_metrics
+    :param namespaces: The namespace each dict in data was pulled from, used as the document type
+    :param document_ids: Whether to give every document an id derived from its namespace, resource and timestamp
+    :return: A generator of newline terminated json strings
+    """
 
-                del source[data_dict['metric']]
-                if 'volume_id' in source:
-                    del source['volume_id']
-                if 'database_id' in source:
-                    del source['database_id']
+    now = datetime.datetime.utcnow()
+
+    for namespace, object in zip(namespaces, data):
+        document_type = namespace.split('/')[-1]
+
+        for key in object:
+            # Metric values are grouped by datapoint (and period), keeping the order they were pulled in
+            documents = []
+            documents_by_datapoint = {}
+
+            for data_dict in object[key]:
+                datapoint = (data_dict.get('timestamp'), data_dict.get('period'))
+                if datapoint not in documents_by_datapoint:
+                    timestamp = data_dict.get('timestamp', now)
+                    document = {'timestamp': format_timestamp(timestamp)}
+                    if 'period' in data_dict:
+                        document['period'] = data_dict['period']
+                    documents_by_datapoint[datapoint] = (timestamp, document)
+                    documents.append(documents_by_datapoint[datapoint])
+
+                document = documents_by_datapoint[datapoint][1]
+                metric = data_dict['metric']
+                for field in data_dict:
+                    if field not in ('metric', 'value', 'unit', 'timestamp', 'statistics', 'period'):
+                        document[field] = data_dict[field]
+                document[metric] = data_dict['value']
+                document['{0}_unit'.format(metric)] = data_dict['unit']
+                for statistic in data_dict.get('statistics', {}):
+                    document['{0}_{1}'.format(metric, statistic.replace('.', '_'))] = data_dict['statistics'][statistic]
 
-    return return_data
+            for timestamp, document in documents:
+                action = {'index': {}}
+                action['index']['_index'] = timestamp.strftime('cw-%Y.%m.%d')
+                action['index']['_type'] = document_type
+                if document_ids:
+                    action['index']['_id'] = document_id(namespace, key, '', document.get('period'), timestamp,
+                                                         document.get('account'))
+                yield '{0}\n'.format(json.dumps(action))
+                yield '{0}\n'.format(json.dumps(document))
 
 
-def make_request(endpoint, data, method='GET'):
+def document_datapoints(data, namespaces, wide=False):
     """
-    This function handles a HTTP request to a given elasticsearch domain endpoint and method.
+    Lists the metric values held by each document, in the order generate_bulk_lines (or generate_wide_bulk_lines,
+    if wide is set) writes the documents.
+    :param data: A list of dicts of resource id to a list of metric values, as returned by get_metrics
+    :param namespaces: The namespace each dict in data was pulled from
+    :param wide: Whether the documents were written with one document per resource and timestamp
+    :return: A list with a list of (namespace, resource id, metric value) tuples for each document
+    """
+
+    documents = []
+
+    for namespace, object in zip(namespaces, data):
+        for key in object:
+            if not wide:
+                documents.extend([(namespace, key, data_dict)] for data_dict in object[key])
+                continue
+
+            documents_by_datapoint = {}
+            for data_dict in object[key]:
+                datapoint = (data_dict.get('timestamp'), data_dict.get('period'))
+                if datapoint not in documents_by_datapoint:
+                    documents_by_datapoint[datapoint] = []
+                    documents.append(documents_by_datapoint[datapoint])
+                documents_by_datapoint[datapoint].append((namespace, key, data_dict))
+
+    return documents
+
+
+def document_id(namespace, resource_id, metric, period, timestamp, account=None):
+    """
+    :param namespace: The cloudwatch namespace the metric value was pulled from
+    :param resource_id: The id of the resource the metric value belongs to
+    :param metric: The name of the metric, or an empty string for documents holding every metric
+    :param period: The period of the datapoint, or None if only one period is collected
+    :param timestamp: The timestamp of the datapoint
+    :param account: The account the metric value was pulled from, if it isn't the lambda's own
+    :return: An id that is the same every time the datapoint is collected
+    """
+
+    parts = [namespace, resource_id, metric, str(period or ''), format_timestamp(timestamp)]
+    if account:
+        parts.insert(0, account)
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()
+
+
+def format_timestamp(timestamp):
+    """
+    :param timestamp: A datetime in UTC
+    :return: The timestamp in the format the documents in elasticsearch use
+    """
+
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.{0}Z'.format(int(round(timestamp.microsecond/1000.0))))
+
+
+def chunk_bulk_lines(lines, max_bytes, max_documents):
+    """
+    Groups the lines of a _bulk request into chunks that stay within the size and document count limits.
+    A single document larger than max_bytes is sent in a chunk of its own.
+    :param lines: An iterable of _bulk lines, alternating between action and document lines
+    :param max_bytes: The maximum size of each chunk
+    :param max_documents: The maximum number of documents in each chunk
+    :return: A generator of lists of (action line, document line) tuples
+    """
+
+    chunk = []
+    chunk_bytes = 0
+    lines = iter(lines)
+
+    for action_line in lines:
+        pair = (action_line, next(lines))
+        pair_bytes = len(pair[0]) + len(pair[1])
+
+        if chunk and (chunk_bytes + pair_bytes > max_bytes or len(chunk) >= max_documents):
+            yield chunk
+            chunk = []
+            chunk_bytes = 0
+
+        chunk.append(pair)
+        chunk_bytes += pair_bytes
+
+    if chunk:
+        yield chunk
+
+
+def send_bulk(endpoint, lines, max_bytes=DEFAULT_BULK_MAX_BYTES, max_documents=DEFAULT_BULK_MAX_DOCUMENTS,
+              max_retries=DEFAULT_BULK_RETRIES, compress=False, retry_deadline=None):
+    """
+    Sends _bulk lines to elasticsearch in size limited chunks, checking the result of every document.
+    Documents rejected because elasticsearch is too busy (status 429) are sent again with an increasing delay,
+    any other failures are reported and counted. Rejected documents that can't be sent again before the
+    retry deadline are counted as failed rather than waited on.
     :param endpoint: The elasticsearch domain endpoint
-    :param data: The data to send along with the request
-    :param method: the type of HTTP method to use. eg: 'GET POST DELETE etc'
-    :return: The response of the request
+    :param lines: An iterable of _bulk lines, alternating between action and document lines
+    :param max_bytes: The maximum size of each _bulk request
+    :param max_documents: The maximum number of documents in each _bulk request
+    :param max_retries: The number of times rejected documents are sent again
+    :param compress: Whether to gzip each _bulk request
+    :param retry_deadline: The time, in seconds since the epoch, after which rejected documents aren't sent again
+    :return: A dict with the number of 'indexed' and 'failed' documents, and the positions of the documents that
+    were only 'retryable' failures, because elasticsearch was too busy to index them
     """
 
-    host = endpoint
-    endpoint = '{0}/_bulk'.format(host)
-    region = endpoint.split('.')[1]
-    service = endpoint.split('.')[2]
-    credentials = boto3.session.Session().get_credentials()
-    request = AWSRequest(method=method, url='https://{0}'.format(endpoint), data=data)
-    SigV4Auth(credentials, service, region).add_auth(request)
-    headers = dict(request.headers.items())
-    opener = urllib2.build_opener(urllib2.HTTPHandler)
-    request = urllib2.Request('https://{0}'.format(endpoint), request.data)
+    summary = {'indexed': 0, 'failed': 0, 'retryable': []}
+    sent = 0
+
+    for chunk in chunk_bulk_lines(lines, max_bytes, max_documents):
+        # Each document is kept with its position in lines, so the caller can tell which ones weren't indexed
+        pending = list(enumerate(chunk, sent))
+        sent += len(chunk)
+
+        for attempt in range(max_retries + 1):
+            if attempt:
+                delay = random.uniform(0.5, 1) * BULK_RETRY_BASE_DELAY * 2 ** (attempt - 1)
+                if retry_deadline is not None and time.time() + delay > retry_deadline:
+                    print('Out of time to send {0} rejected documents again, counting them as failed'
+                          .format(len(pending)))
+                    summary['failed'] += len(pending)
+                    summary['retryable'].extend(position for position, _ in pending)
+                    break
+                time.sleep(delay)
+
+            try:
+                response = json.loads(es_client.make_request('{0}/_bulk'.format(endpoint),
+                                                             ''.join(''.join(pair) for _, pair in pending),
+                                                             method='POST', compress=compress))
+            except es_client.RequestError as e:
+                if e.status != 429:
+                    raise
+                if attempt == max_retries:
+                    print('Elasticsearch rejected a _bulk request of {0} documents too many times, counting them '
+                          'as failed'.format(len(pending)))
+                    summary['failed'] += len(pending)
+                    summary['retryable'].extend(position for position, _ in pending)
+                    break
+                print('Elasticsearch rejected a _bulk request of {0} documents, sending it again'.format(len(pending)))
+                continue
+
+            rejected = []
+            for (position, pair), item in zip(pending, response['items']):
+                result = list(item.values())[0]
+                status = result.get('status', 500)
+
+                if status < 300:
+                    summary['indexed'] += 1
+                elif status == 429 and attempt < max_retries:
+                    rejected.append((position, pair))
+                else:
+                    summary['failed'] += 1
+                    if status == 429:
+                        summary['retryable'].append(position)
+                    print('Failed to index document {0}. Error was: {1}'.format(pair[1].strip(), result.get('error')))
 
-    request.add_header('Host', host)
-    request.add_header('Content-Type', 'application/json')
-    request.add_header('X-Amz-Date', headers['X-Amz-Date'])
-    request.add_header('X-Amz-Security-Token', headers['X-Amz-Security-Token'])
-    request.add_header('Authorization', headers['Authorization'])
-    request.get_method = lambda: method
+            if not rejected:
+                break
 
-    print(request.data)
+            print('Elasticsearch rejected {0} documents, sending them again'.format(len(rejected)))
+            pending = rejected
 
-    return opener.open(request).read()
+    return summary
 
 
 def lambda_handler(event, context):
@@ -172,4 +1170,4 @@ def lambda_handler(event, context):
     :param context: AWS Lambda uses this parameter to provide runtime information to your handler.
     Context: https://docs.aws.amazon.com/lambda/latest/dg/python-context-object.html
     """
-    get_other_metrics(event)
+    get_other_metrics(event, context)
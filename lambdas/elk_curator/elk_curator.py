@@ -1,17 +1,91 @@
 from __future__ import print_function
 import boto3
-import urllib2
 import re
+import json
+import hashlib
 import datetime
-from botocore.auth import SigV4Auth
-from botocore.awsrequest import AWSRequest
-import cStringIO
+import time
+from es_client import make_request, RequestError
 
+# The number of days indices are kept for if their prefix doesn't have its own limit
+DEFAULT_MAX_AGE_DAYS = 30
 
-def run_curator(name):
+# The date at the end of daily index names. eg: 'cw-2017.01.31'
+DATE_SUFFIX = r'(\d{4})[.](\d{1,2})[.](\d{1,2})$'
+
+# Matches any dated index, splitting it into its prefix and date
+DATED_INDEX_PATTERN = re.compile('^(.*?)' + DATE_SUFFIX)
+
+# The columns requested from _cat/indices. Hidden indices such as .kibana are never dated, so they're left out.
+INDICES_PATH = '_cat/indices/*,-.*?format=json&bytes=b&h=index,status,docs.count,store.size'
+
+# The fields that identify the resource a metric document belongs to, which rollups are grouped by
+ROLLUP_ID_FIELDS = ['instance', 'volume_id', 'database_id', 'distribution_id', 'load_balancer', 'table_name',
+                    'function_name', 'queue_name']
+
+# Metrics collected from several accounts are tagged with this field. Resources in different accounts can share an
+# id, so rollups are also grouped by it, and documents without it are rolled up under an empty account.
+ROLLUP_ACCOUNT_FIELD = 'account'
+
+# The number of rollup documents written in each _bulk request
+ROLLUP_BULK_DOCUMENTS = 1000
+
+# Rolling up an index takes several requests, so only this many indices are rolled up per run. Expired indices
+# waiting to be rolled up are kept until a later run has rolled them up, unless disk space is needed.
+DEFAULT_ROLLUP_MAX_INDICES = 5
+
+# Rolling up an index can keep failing, eg. if it is too large to summarise within the lambda's timeout.
+# Indices that still haven't been rolled up this many days after they expired are deleted without a rollup.
+DEFAULT_ROLLUP_GRACE_DAYS = 7
+
+# The number of seconds to wait for each search and _bulk request of a rollup
+ROLLUP_TIMEOUT = 100
+
+# Indices are given this alias once they have been rolled up, so a later run can delete them without
+# rolling them up again
+ROLLED_UP_ALIAS = 'rolled-up'
+
+# Elasticsearch field types that hold metric values
+NUMERIC_FIELD_TYPES = ['long', 'integer', 'short', 'double', 'float']
+
+# Force merging blocks until it finishes, so only this many indices are optimised per run.
+# Any left over are picked up by the next run.
+DEFAULT_OPTIMISE_MAX_INDICES = 5
+
+# The number of seconds to wait for the force merge of a single index. Merging on a small instance can take
+# minutes, and elasticsearch carries on merging if the request gives up waiting.
+FORCEMERGE_TIMEOUT = 100
+
+# Force merges and rollups aren't started with less than this many seconds left before the lambda times out
+LAMBDA_TIMEOUT_MARGIN_SECONDS = 10
+
+# Elasticsearch rejects requests whose first line is longer than 4096 bytes, so the comma separated
+# list of indices in each delete request is kept below this many characters
+MAX_DELETE_PATH_LENGTH = 3500
+
+
+def run_curator(name, dry_run=False, retention=None, target_free_percent=None, optimise_after_days=None,
+                optimise_replicas=None, rollup_prefixes=None, rollup_grace_days=None, deadline=None):
     """
-    Cleans out any indices older than 30 days from the elasticsearch domain with the provided name
+    Cleans out old indices from the elasticsearch domain with the provided name.
+    Dated indices are deleted once they are older than the age limit for their prefix (30 days by default).
+    If a target amount of free disk space is set, the oldest remaining indices are also deleted until the
+    domain is expected to have that much free space. The newest index of each prefix is never deleted.
+    Indices that don't need rolling up, and those needed to free disk space, are deleted first. Expired indices
+    waiting to be rolled up are then rolled up a few at a time, and deleted once they have been, or once they are
+    too far past their age limit.
     :param name: the name of the elasticsearch domain to curate.
+    :param dry_run: if True, the indices that would be deleted are printed without deleting them
+    :param retention: a dict of index prefix to the number of days to keep its indices for. eg: {'cw-': 30}
+    :param target_free_percent: the percentage of the domain's disk space to keep free
+    :param optimise_after_days: if set, indices older than this many days that are kept are made read-only and
+    force merged, see optimise_indices
+    :param optimise_replicas: the number of replicas to reduce optimised indices to
+    :param rollup_prefixes: if set, indices with these prefixes are summarised into hourly and daily rollup
+    indices before they are deleted, see rollup_index
+    :param rollup_grace_days: the number of days past their age limit that indices which can't be rolled up are kept
+    for before they are deleted anyway. default: DEFAULT_ROLLUP_GRACE_DAYS
+    :param deadline: the time, in seconds since the epoch, that the curator must finish by. eg: the lambda's timeout
     """
 
     boto_elasticsearch = boto3.client('es')
@@ -26,58 +100,475 @@ def run_curator(name):
 
     endpoint = es_status['DomainStatus']['Endpoint']
 
-    table_of_data = make_request('{0}/_cat/indices?v'.format(endpoint))
-
-    list_of_indices = []
-    deleted_indices = []
-
-    indices = cStringIO.StringIO(table_of_data)
-    for line in indices:
-        line_list = line.strip().split()
-        list_of_indices.append(line_list[2])
+    indices = json.loads(make_request('{0}/{1}'.format(endpoint, INDICES_PATH)))
 
     today = datetime.datetime.now()
 
     print('Today: {0}'.format(today.strftime('%Y-%m-%d')))
-    print('Indices found: {0}'.format(', '.join(list_of_indices)))
+    print('Indices found: {0}'.format(', '.join(index['index'] for index in indices)))
+
+    dated_indices = parse_indices(indices, retention or {})
+    expired_indices = plan_age_deletions(dated_indices, today)
+
+    expired = set(expired_indices)
+    rollup_prefixes = rollup_prefixes or []
+    rolled_up = get_rolled_up_indices(endpoint) if rollup_prefixes else set()
+
+    # Closed indices can't be searched, so they are deleted without being rolled up
+    oldest_first = sorted(dated_indices, key=lambda index: (index['date'], index['index']))
+    candidates = [index for index in oldest_first
+                  if index['index'] in expired and index['prefix'] in rollup_prefixes
+                  and index.get('status') != 'close' and index['index'] not in rolled_up]
+
+    # Indices that have failed to roll up for too long are deleted anyway, so they can't be kept forever
+    grace_days = DEFAULT_ROLLUP_GRACE_DAYS if rollup_grace_days is None else int(rollup_grace_days)
+    overdue = [index['index'] for index in candidates if (today - index['date']).days > index['max_age'] + grace_days]
+    if overdue:
+        print('Warning: could not roll up {0} within {1} days of expiring, deleting them without a rollup'
+              .format(', '.join(overdue), grace_days))
+    awaiting_rollup = [index['index'] for index in candidates
+                       if (today - index['date']).days <= index['max_age'] + grace_days]
+
+    awaiting = set(awaiting_rollup)
+    deleted_indices = [index for index in expired_indices if index not in awaiting]
+
+    if target_free_percent is not None:
+        # A full domain stops accepting writes, so these are deleted whether or not they have been rolled up
+        deleted_indices += plan_disk_deletions(dated_indices, deleted_indices, get_disk_usage(endpoint),
+                                               float(target_free_percent))
+        deleted = set(deleted_indices)
+        awaiting_rollup = [index for index in awaiting_rollup if index not in deleted]
+
+    delete_indices(endpoint, deleted_indices, dry_run=dry_run)
+
+    if awaiting_rollup:
+        delete_indices(endpoint, rollup_indices(endpoint, awaiting_rollup, dry_run=dry_run, deadline=deadline),
+                       dry_run=dry_run)
+
+    if optimise_after_days is not None:
+        # Expired indices still waiting to be rolled up are deleted by a later run, so they aren't optimised
+        removed = expired | set(deleted_indices)
+        kept_indices = [index for index in dated_indices if index['index'] not in removed]
+        optimise_indices(endpoint, kept_indices, today, int(optimise_after_days), replicas=optimise_replicas,
+                         dry_run=dry_run, deadline=deadline)
+
+
+def delete_indices(endpoint, indices, dry_run=False):
+    """
+    Deletes indices in as few requests as possible, see batch_indices.
+    :param endpoint: The elasticsearch domain endpoint
+    :param indices: a list of index names
+    :param dry_run: if True, the requests that would delete the indices are printed without sending them
+    """
+
+    batches = batch_indices(sorted(indices))
+
+    if dry_run:
+        print('Dry run: {0} indices would be deleted in {1} requests'.format(len(indices), len(batches)))
+        for batch in batches:
+            print('DELETE {0}/{1}'.format(endpoint, ','.join(batch)))
+        return
+
+    for batch in batches:
+        make_request('{0}/{1}'.format(endpoint, ','.join(batch)), method='DELETE')
+
+    if indices:
+        print('Found and deleted the following old indices: {0}'.format(', '.join(indices)))
+
+
+def rollup_indices(endpoint, indices, max_indices=DEFAULT_ROLLUP_MAX_INDICES, dry_run=False, deadline=None):
+    """
+    Rolls up the first few of the provided indices, see rollup_index, giving each one the ROLLED_UP_ALIAS alias
+    once it has been rolled up. Any left over, or that fail, are rolled up by a later run.
+    :param endpoint: The elasticsearch domain endpoint
+    :param indices: a list of the names of the indices to roll up, oldest first
+    :param max_indices: the maximum number of indices to roll up in this run
+    :param dry_run: if True, the indices that would be rolled up are printed without rolling them up
+    :param deadline: the time, in seconds since the epoch, after which no more rollup requests are sent
+    :return: a list of the names of the indices that were rolled up
+    """
+
+    pending = indices[:max_indices]
+    if len(indices) > len(pending):
+        print('{0} more expired indices are waiting to be rolled up, and will be rolled up and deleted by later runs'
+              .format(len(indices) - len(pending)))
+
+    if dry_run:
+        print('Dry run: would roll up {0}'.format(', '.join(pending)))
+        return pending
+
+    rolled_up = []
+    for index in pending:
+        if request_timeout(deadline, ROLLUP_TIMEOUT) <= 0:
+            print('Out of time to roll up more indices, the rest will be rolled up by the next run')
+            break
+
+        try:
+            rollup_index(endpoint, index, deadline=deadline)
+            make_request('{0}/{1}/_alias/{2}'.format(endpoint, index, ROLLED_UP_ALIAS), method='PUT')
+        except Exception as e:
+            # The raw data is kept until it has been rolled up, or its grace period runs out
+            print('Could not roll up {0}, it will be tried again by the next run. Error was: {1}'.format(index, e))
+            continue
+        rolled_up.append(index)
+
+    return rolled_up
+
+
+def get_rolled_up_indices(endpoint):
+    """
+    :param endpoint: The elasticsearch domain endpoint
+    :return: a set of the names of the indices that have been rolled up but not deleted yet
+    """
+
+    try:
+        return set(json.loads(make_request('{0}/_alias/{1}'.format(endpoint, ROLLED_UP_ALIAS))))
+    except RequestError as e:
+        # Elasticsearch responds with a 404 when no index has the alias
+        if e.status == 404:
+            return set()
+        raise
+
+
+def optimise_indices(endpoint, dated_indices, today, after_days, replicas=None,
+                     max_indices=DEFAULT_OPTIMISE_MAX_INDICES, dry_run=False, deadline=None):
+    """
+    Optimises daily indices that no longer receive writes by force merging them down to a single segment,
+    then blocking writes to them and optionally reducing their replicas.
+    The write block is applied last and marks an index as done, so each index is only optimised once.
+    Each index is merged in its own request, and one that fails or takes too long is tried again by the next run.
+    :param endpoint: The elasticsearch domain endpoint
+    :param dated_indices: a list of dicts describing each dated index, with its 'index' name and 'date'
+    :param today: the date to measure the age of the indices from
+    :param after_days: the number of days old an index must be before it is optimised
+    :param replicas: if set, the number of replicas to reduce each optimised index to
+    :param max_indices: the maximum number of indices to optimise in this run
+    :param dry_run: if True, the indices that would be optimised are printed without changing them
+    :param deadline: the time, in seconds since the epoch, after which no more force merges are started
+    """
+
+    candidates = [index['index'] for index in sorted(dated_indices, key=lambda index: (index['date'], index['index']))
+                  if (today - index['date']).days > after_days and index.get('status', 'open') == 'open']
+    if not candidates:
+        return
+
+    settings = json.loads(make_request('{0}/_settings/index.blocks.write?flat_settings=true'.format(endpoint)))
+    pending = [index for index in candidates
+               if settings.get(index, {}).get('settings', {}).get('index.blocks.write') != 'true']
+    pending = pending[:max_indices]
+
+    if not pending:
+        return
+
+    new_settings = {'index.blocks.write': True}
+    if replicas is not None:
+        new_settings['index.number_of_replicas'] = int(replicas)
+
+    if dry_run:
+        print('Dry run: would force merge and apply {0} to {1}'.format(json.dumps(new_settings), ', '.join(pending)))
+        return
+
+    optimised = []
+    for index in pending:
+        timeout = request_timeout(deadline, FORCEMERGE_TIMEOUT)
+        if timeout <= 0:
+            print('Out of time to optimise more indices, the rest will be optimised by the next run')
+            break
 
-    regex = '(\d{4})[.](\d{1,2})[.](\d{1,2})$'
-    for index in list_of_indices:
-        if re.search(regex, index):
-            parsed_index_date = '.'.join(re.findall(regex, index)[0][:3])
-            index_date = datetime.datetime.strptime(parsed_index_date, '%Y.%m.%d')
-            delta = today - index_date
-            if delta.days > 30:
-                deleted_indices.append(index)
-                make_request('{0}/{1}'.format(endpoint, index), 'DELETE')
+        try:
+            make_request('{0}/{1}/_forcemerge?max_num_segments=1'.format(endpoint, index), method='POST',
+                         timeout=timeout)
+            make_request('{0}/{1}/_settings'.format(endpoint, index), json.dumps(new_settings), method='PUT')
+        except Exception as e:
+            print('Could not optimise {0}, it will be tried again by the next run. Error was: {1}'.format(index, e))
+            continue
+        optimised.append(index)
 
-    if deleted_indices:
-        print('Found and deleted the following old indices: {0}'.format(', '.join(deleted_indices)))
+    if optimised:
+        print('Optimised the following indices: {0}'.format(', '.join(optimised)))
 
 
-def make_request(endpoint, method='GET'):
+def request_timeout(deadline, maximum):
+    """
+    :param deadline: the time, in seconds since the epoch, that the curator must finish by, or None if there isn't one
+    :param maximum: the most number of seconds to wait for the request
+    :return: the number of seconds a request can wait for while still finishing LAMBDA_TIMEOUT_MARGIN_SECONDS
+    before the deadline. 0 or less if there is no time left
+    """
+
+    if deadline is None:
+        return maximum
+    return min(maximum, deadline - time.time() - LAMBDA_TIMEOUT_MARGIN_SECONDS)
+
+
+def rollup_index(endpoint, index, deadline=None):
+    """
+    Summarises a daily metric index into hourly and daily documents holding the min, max, avg, sum and count of
+    every metric for each resource and account. Hourly documents go into a 'rollup-hourly-%Y.%m' index and daily
+    documents into a 'rollup-daily-%Y' index. Every rollup document has an id derived from its contents' index,
+    resource, account, metric and time, so rolling up the same index again overwrites rather than duplicates.
+    :param endpoint: The elasticsearch domain endpoint
+    :param index: the name of the index to roll up
+    :param deadline: the time, in seconds since the epoch, that each request must finish by, see request_timeout
+    """
+
+    def timeout():
+        seconds = request_timeout(deadline, ROLLUP_TIMEOUT)
+        if seconds <= 0:
+            raise RuntimeError('Ran out of time before {0} was rolled up'.format(index))
+        return seconds
+
+    mappings = json.loads(make_request('{0}/{1}/_mapping'.format(endpoint, index)))[index]['mappings']
+    types = dict((document_type, mapping.get('properties', {})) for document_type, mapping in mappings.items()
+                 if document_type != '_default_')
+
+    # Every type inherits the fields of the template's _default_ mapping, eg. every id field and some metrics of
+    # other namespaces, so only the fields its documents actually hold are aggregated
+    fields = set(field for properties in types.values() for field in properties
+                 if field in ROLLUP_ID_FIELDS or field == ROLLUP_ACCOUNT_FIELD
+                 or (properties[field].get('type') in NUMERIC_FIELD_TYPES and field != 'period'))
+    present = present_fields(endpoint, index, sorted(fields), timeout()) if fields else {}
+    rollups = []
+
+    for document_type, properties in sorted(types.items()):
+        held = present.get(document_type, set())
+        id_fields = [field for field in ROLLUP_ID_FIELDS if field in properties and field in held]
+        metrics = [field for field in sorted(properties) if properties[field].get('type') in NUMERIC_FIELD_TYPES
+                   and field != 'period' and field not in id_fields and field in held]
+        if not id_fields or not metrics:
+            continue
+
+        # Elasticsearch 2.x has no composite aggregation, so each resource field is bucketed with terms
+        # (size 0 returns every term), then by account if the index has one, and then by hour
+        resource_aggs = {'hours': {'date_histogram': {'field': 'timestamp', 'interval': 'hour'},
+                                   'aggs': dict((metric, {'stats': {'field': metric}}) for metric in metrics)}}
+        has_account = ROLLUP_ACCOUNT_FIELD in held
+        if has_account:
+            resource_aggs = {'accounts': {'terms': {'field': ROLLUP_ACCOUNT_FIELD, 'size': 0, 'missing': ''},
+                                          'aggs': resource_aggs}}
+        query = {
+            'size': 0,
+            'query': {'type': {'value': document_type}},
+            'aggs': dict((field, {'terms': {'field': field, 'size': 0}, 'aggs': resource_aggs})
+                         for field in id_fields)
+        }
+        response = json.loads(make_request('{0}/{1}/_search'.format(endpoint, index), json.dumps(query),
+                                           method='POST', timeout=timeout()))
+
+        for field in id_fields:
+            for resource in response['aggregations'][field]['buckets']:
+                accounts = resource['accounts']['buckets'] if has_account else [dict(resource, key='')]
+                for account in accounts:
+                    for hour in account['hours']['buckets']:
+                        for metric in metrics:
+                            stats = hour[metric]
+                            if stats['count']:
+                                rollups.append((field, resource['key'], account['key'], metric, hour['key'],
+                                                stats))
+
+    daily = {}
+    lines = []
+    for field, resource, account, metric, hour, stats in rollups:
+        timestamp = datetime.datetime.utcfromtimestamp(hour / 1000)
+        lines.extend(rollup_lines('rollup-hourly', timestamp.strftime('rollup-hourly-%Y.%m'), field, resource,
+                                  account, metric, timestamp, stats))
+
+        day = daily.setdefault((field, resource, account, metric, timestamp.date()), {
+            'min': stats['min'], 'max': stats['max'], 'sum': 0, 'count': 0})
+        day['min'] = min(day['min'], stats['min'])
+        day['max'] = max(day['max'], stats['max'])
+        day['sum'] += stats['sum']
+        day['count'] += stats['count']
+
+    for (field, resource, account, metric, date), stats in sorted(daily.items()):
+        stats['avg'] = stats['sum'] / stats['count']
+        timestamp = datetime.datetime(date.year, date.month, date.day)
+        lines.extend(rollup_lines('rollup-daily', timestamp.strftime('rollup-daily-%Y'), field, resource, account,
+                                  metric, timestamp, stats))
+
+    for offset in range(0, len(lines), 2 * ROLLUP_BULK_DOCUMENTS):
+        body = '\n'.join(lines[offset:offset + 2 * ROLLUP_BULK_DOCUMENTS]) + '\n'
+        response = json.loads(make_request('{0}/_bulk'.format(endpoint), body, method='POST', timeout=timeout()))
+        if response.get('errors'):
+            raise RequestError(200, 'Rollup documents were rejected', json.dumps(
+                [item for item in response['items'] if list(item.values())[0].get('status', 500) >= 300][:5]))
+
+    print('Rolled up {0} into {1} rollup documents'.format(index, len(lines) // 2))
+
+
+def present_fields(endpoint, index, fields, timeout):
+    """
+    Finds which fields the documents of each type in an index hold a value for, in a single search.
+    :param endpoint: The elasticsearch domain endpoint
+    :param index: the name of the index to search
+    :param fields: the names of the fields to look for
+    :param timeout: the number of seconds to wait for the search
+    :return: a dict of each document type to the set of the fields at least one of its documents holds
+    """
+
+    query = {
+        'size': 0,
+        'aggs': {'types': {'terms': {'field': '_type', 'size': 0},
+                           'aggs': dict((field, {'filter': {'exists': {'field': field}}}) for field in fields)}}
+    }
+    response = json.loads(make_request('{0}/{1}/_search'.format(endpoint, index), json.dumps(query), method='POST',
+                                       timeout=timeout))
+
+    return dict((bucket['key'], set(field for field in fields if bucket[field]['doc_count']))
+                for bucket in response['aggregations']['types']['buckets'])
+
+
+def rollup_lines(kind, rollup_index_name, field, resource, account, metric, timestamp, stats):
+    """
+    :param account: The account the resource belongs to, or an empty string if its documents weren't tagged with one
+    :return: The _bulk action and document lines of one rollup document
+    """
+
+    iso_timestamp = timestamp.strftime('%Y-%m-%dT%H:%M:%S.0Z')
+    # The account is only part of the id when there is one, so rollups of untagged documents keep their ids
+    id_parts = [kind, field, resource] + ([u'{0}'.format(account)] if account != '' else []) + [metric, iso_timestamp]
+    document_id = hashlib.sha1(u'|'.join(id_parts).encode('utf-8')).hexdigest()
+    action = {'index': {'_index': rollup_index_name, '_type': 'rollup', '_id': document_id}}
+    source = {
+        'timestamp': iso_timestamp,
+        field: resource,
+        'metric': metric,
+        'min': stats['min'],
+        'max': stats['max'],
+        'avg': stats['avg'],
+        'sum': stats['sum'],
+        'count': stats['count']
+    }
+    if account != '':
+        source[ROLLUP_ACCOUNT_FIELD] = account
+
+    return [json.dumps(action), json.dumps(source)]
+
+
+def parse_indices(indices, retention):
+    """
+    Picks out the dated indices from a _cat/indices listing in a single pass, adding the 'prefix', 'date' and
+    'max_age' of each one. Each retention prefix has its own pattern, compiled once per run.
+    :param indices: a list of dicts describing each index, as returned by _cat/indices in json
+    :param retention: a dict of index prefix to the number of days to keep its indices for
+    :return: a list of the dicts of the dated indices
+    """
+
+    # The longest matching prefix wins, so 'cw-rollup-' can be kept longer than 'cw-'
+    patterns = [(re.compile('^({0}.*?)'.format(re.escape(prefix)) + DATE_SUFFIX), int(retention[prefix]))
+                for prefix in sorted(retention, key=len, reverse=True)]
+    patterns.append((DATED_INDEX_PATTERN, DEFAULT_MAX_AGE_DAYS))
+
+    dated_indices = []
+
+    for index in indices:
+        for pattern, max_age in patterns:
+            match = pattern.match(index['index'])
+            if match:
+                prefix, year, month, day = match.groups()
+                try:
+                    index['date'] = datetime.datetime(int(year), int(month), int(day))
+                except ValueError:
+                    break
+                index['prefix'] = prefix
+                index['max_age'] = max_age
+                dated_indices.append(index)
+                break
+
+    return dated_indices
+
+
+def plan_age_deletions(dated_indices, today):
+    """
+    Finds the indices that are older than the age limit for their prefix.
+    :param dated_indices: a list of dicts describing each dated index, with its 'index' name, 'date' and 'max_age'
+    :param today: the date to measure the age of the indices from
+    :return: a list of index names
+    """
+
+    return [index['index'] for index in dated_indices if (today - index['date']).days > index['max_age']]
+
+
+def plan_disk_deletions(dated_indices, deleted_indices, disk, target_free_percent):
+    """
+    Picks the oldest indices to delete until the domain is expected to have the target amount of free space.
+    :param dated_indices: a list of dicts describing each dated index, including its 'store.size' in bytes
+    :param deleted_indices: the names of the indices that are already going to be deleted
+    :param disk: a dict of the 'total' and 'available' bytes of disk space in the domain
+    :param target_free_percent: the percentage of the domain's disk space to keep free
+    :return: a list of index names
+    """
+
+    if not disk['total']:
+        return []
+
+    available = disk['available']
+    remaining = []
+    deleted_indices = set(deleted_indices)
+    for index in dated_indices:
+        if index['index'] in deleted_indices:
+            available += int(index.get('store.size') or 0)
+        else:
+            remaining.append(index)
+
+    # The newest index of each prefix is the one currently being written to, so it is always kept
+    newest = {}
+    for index in remaining:
+        if index['prefix'] not in newest or index['date'] > newest[index['prefix']]['date']:
+            newest[index['prefix']] = index
+
+    freed = []
+    for index in sorted(remaining, key=lambda index: (index['date'], index['index'])):
+        if 100.0 * available / disk['total'] >= target_free_percent:
+            break
+        if newest[index['prefix']] is index:
+            continue
+        freed.append(index['index'])
+        available += int(index.get('store.size') or 0)
+
+    if freed:
+        print('Free disk space is below {0}%, deleting {1} more of the oldest indices'
+              .format(target_free_percent, len(freed)))
+
+    return freed
+
+
+def get_disk_usage(endpoint):
     """
-    This function handles a HTTP request to a given elasticsearch domain endpoint and method.
     :param endpoint: The elasticsearch domain endpoint
-    :param method: the type of HTTP method to use. eg: 'GET POST DELETE etc'
-    :return: The response of the request
+    :return: a dict of the 'total' and 'available' bytes of disk space across the domain's data nodes
+    """
+
+    disk = {'total': 0, 'available': 0}
+
+    for node in json.loads(make_request('{0}/_cat/allocation?format=json&bytes=b'.format(endpoint))):
+        # Unassigned shards are listed as a node without any disk
+        if node.get('disk.total') and node.get('disk.avail'):
+            disk['total'] += int(node['disk.total'])
+            disk['available'] += int(node['disk.avail'])
+
+    return disk
+
+
+def batch_indices(indices, max_length=MAX_DELETE_PATH_LENGTH):
+    """
+    Splits a list of indices into batches that can each be deleted with a single request.
+    :param indices: a list of index names
+    :param max_length: the maximum length of the comma separated list of indices in each batch
+    :return: a list of lists of index names
     """
 
-    region = endpoint.split('.')[1]
-    service = endpoint.split('.')[2]
-    credentials = boto3.session.Session().get_credentials()
-    request = AWSRequest(method=method, url='https://{0}'.format(endpoint))
-    SigV4Auth(credentials, service, region).add_auth(request)
-    headers = dict(request.headers.items())
-    opener = urllib2.build_opener(urllib2.HTTPHandler)
-    request = urllib2.Request('https://{0}'.format(endpoint))
+    batches = []
+    batch_length = 0
 
-    request.add_header('X-Amz-Date', headers['X-Amz-Date'])
-    request.add_header('X-Amz-Security-Token', headers['X-Amz-Security-Token'])
-    request.add_header('Authorization', headers['Authorization'])
-    request.get_method = lambda: method
+    for index in indices:
+        if not batches or batch_length + len(index) + 1 > max_length:
+            batches.append([])
+            batch_length = 0
+        batches[-1].append(index)
+        batch_length += len(index) + 1
 
-    return opener.open(request).read()
+    return batches
 
 
 def lambda_handler(event, context):
@@ -87,4 +578,10 @@ def lambda_handler(event, context):
     :param context: AWS Lambda uses this parameter to provide runtime information to your handler.
     Context: https://docs.aws.amazon.com/lambda/latest/dg/python-context-object.html
     """
-    run_curator(event['domainname'])
\ No newline at end of file
+    run_curator(event['domainname'], dry_run=event.get('dry_run', False), retention=event.get('retention'),
+                target_free_percent=event.get('target_free_percent'),
+                optimise_after_days=event.get('optimise_after_days'),
+                optimise_replicas=event.get('optimise_replicas'),
+                rollup_prefixes=event.get('rollup_prefixes'),
+                rollup_grace_days=event.get('rollup_grace_days'),
+                deadline=time.time() + context.get_remaining_time_in_millis() / 1000.0)
\ No newline at end of file
@@ -0,0 +1,163 @@
+from __future__ import print_function
+import boto3
+import errno
+import gzip
+import httplib
+import socket
+import threading
+import cStringIO
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+
+# The number of seconds to wait for elasticsearch to respond before giving up on a request
+DEFAULT_TIMEOUT = 30
+
+# Socket errors that mean an idle connection had already been closed by the domain, so the request sent on it
+# never reached elasticsearch and can safely be sent again
+CLOSED_CONNECTION_ERRNOS = [errno.ECONNRESET, errno.EPIPE]
+
+# Idle keep-alive connections per elasticsearch host, reused by later requests in the same lambda container
+connection_pool = {}
+pool_lock = threading.Lock()
+
+# The credentials of the lambda's role. botocore refreshes them itself when they are close to expiring.
+credentials_cache = {}
+credentials_lock = threading.Lock()
+
+
+class RequestError(Exception):
+    """
+    Raised when elasticsearch responds to a request with an error status.
+    """
+
+    def __init__(self, status, reason, body):
+        super(RequestError, self).__init__('{0} {1}: {2}'.format(status, reason, body))
+        self.status = status
+        self.body = body
+
+
+def make_request(url, data=None, method='GET', compress=False, timeout=DEFAULT_TIMEOUT):
+    """
+    This function handles a signed HTTP request to an elasticsearch domain, reusing an open connection
+    to the domain where one is available.
+    :param url: The elasticsearch domain endpoint, followed by the path and query string. eg: 'endpoint/_cat/indices'
+    :param data: The data to send along with the request
+    :param method: the type of HTTP method to use. eg: 'GET POST DELETE etc'
+    :param compress: Whether to gzip the data before it is sent
+    :param timeout: The number of seconds to wait for a response
+    :return: The body of the response
+    """
+
+    host, _, path = url.partition('/')
+    path = '/' + path
+
+    headers = {'Host': host}
+    body = data
+
+    if data is not None:
+        headers['Content-Type'] = 'application/json'
+        if compress:
+            buffer = cStringIO.StringIO()
+            with gzip.GzipFile(fileobj=buffer, mode='wb') as gzip_file:
+                gzip_file.write(data)
+            body = buffer.getvalue()
+            headers['Content-Encoding'] = 'gzip'
+
+    # The exact bytes that are sent are signed, so the payload hash matches the compressed body
+    request = AWSRequest(method=method, url='https://{0}{1}'.format(host, path), data=body, headers=headers)
+    SigV4Auth(get_credentials(), host.split('.')[2], host.split('.')[1]).add_auth(request)
+    headers = dict(request.headers.items())
+
+    connection, reused = get_connection(host, timeout)
+    try:
+        response = send(connection, method, path, body, headers)
+    except (httplib.HTTPException, socket.error) as e:
+        connection.close()
+        # Idle connections may have been closed by the domain, so the request is tried once more on a new one.
+        # Anything else, such as a timeout, may have happened after elasticsearch acted on the request,
+        # and sending a _bulk or _forcemerge again would repeat it.
+        if not reused or not connection_was_closed(e):
+            raise
+        connection, reused = httplib.HTTPSConnection(host, timeout=timeout), False
+        try:
+            response = send(connection, method, path, body, headers)
+        except Exception:
+            connection.close()
+            raise
+
+    status, reason, response_body, keep_alive = response
+    if keep_alive:
+        release_connection(host, connection)
+    else:
+        connection.close()
+
+    if status >= 400:
+        raise RequestError(status, reason, response_body)
+
+    return response_body
+
+
+def send(connection, method, path, body, headers):
+    """
+    Sends a request over a connection and reads the whole response so the connection can be reused.
+    :return: A tuple of the status, reason, body of the response and whether the connection can be kept open
+    """
+
+    connection.request(method, path, body, headers)
+    response = connection.getresponse()
+    response_body = response.read()
+    keep_alive = (response.getheader('connection') or '').lower() != 'close'
+
+    return response.status, response.reason, response_body, keep_alive
+
+
+def connection_was_closed(error):
+    """
+    :param error: The error raised while sending a request and reading its response
+    :return: True if the error means the connection was closed before any response could have been produced
+    """
+
+    # socket.timeout is also a socket.error, but the request may already have been acted on
+    if isinstance(error, socket.timeout):
+        return False
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    return isinstance(error, socket.error) and error.errno in CLOSED_CONNECTION_ERRNOS
+
+
+def get_connection(host, timeout):
+    """
+    :return: A tuple of an idle connection to the host, or a new one if there are none, and whether it was reused
+    """
+
+    with pool_lock:
+        idle = connection_pool.get(host)
+        if idle:
+            connection = idle.pop()
+            # The connection may have been opened by a request that waits for a different length of time
+            connection.timeout = timeout
+            if connection.sock:
+                connection.sock.settimeout(timeout)
+            return connection, True
+
+    return httplib.HTTPSConnection(host, timeout=timeout), False
+
+
+def release_connection(host, connection):
+    """
+    Returns a connection to the pool so later requests to the same host can reuse it.
+    """
+
+    with pool_lock:
+        connection_pool.setdefault(host, []).append(connection)
+
+
+def get_credentials():
+    """
+    :return: The credentials of the lambda's role, looked up once per lambda container
+    """
+
+    with credentials_lock:
+        if 'credentials' not in credentials_cache:
+            credentials_cache['credentials'] = boto3.session.Session().get_credentials()
+        return credentials_cache['credentials']